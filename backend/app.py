@@ -1,24 +1,47 @@
-import subprocess
 import json
-from flask import Flask, jsonify, request
-from sqlmodel import SQLModel, create_engine, Session, select, text
+from flask import Flask, Response, g, jsonify, request
+from sqlmodel import SQLModel, Session, select, text
+from sqlalchemy import delete, insert, inspect, literal, update
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
 from google.cloud import pubsub_v1
 import logging
 import time
-from models import User, Domain, Permutation, Schedule
+from models import User, Domain, Schedule, ScanJobRecord
+from scan_jobs import ScanJobManager, ScanFailedError, QueueFullError
+from scan_engine import create_scan_engine, ScanEngineError
+from scan_worker import (SCAN_DISPATCH, SCAN_REQUEST_TYPE, PubSubScanDispatcher, handle_scan_message,
+                         record_to_dict, subscriber_flow_control)
+from queries import (DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, permutation_filters, permutation_page, permutation_rows,
+                     iter_permutation_rows)
+from serialization import (STREAM_BATCH_SIZE, json_response, ndjson_chunks, json_object_chunks, make_etag,
+                           not_modified, with_etag, cached_json_response)
+from cache import create_cache, user_tag, domain_tag
+from scheduler import ScanScheduler, SCHEDULER_ENABLED, slot_after, plan_scan_load
+from metrics import (REGISTRY, CONTENT_TYPE, HTTP_REQUEST_SECONDS, SCAN_DNSTWIST_SECONDS, SCAN_COMMIT_SECONDS, PERMUTATIONS_PROCESSED, PERMUTATIONS_SKIPPED, SCAN_FAILURES,
+                     SCANS_IN_FLIGHT, SCAN_QUEUE_DEPTH, PUBSUB_MESSAGES_RECEIVED, timed_iter)
+from tracing import (tracer, configure_tracing, start_server_span, end_server_span, extract_context,
+                     inject_context, traced_iter)
+from opentelemetry.trace import SpanKind
+from profiling import install_profiler
+from db import API_ROLE, SCAN_ROLE, create_db_engine, pool_stats
+from counters import CountReconciler, remove_domain_counts
+from background import BackgroundOwner
+from startup import Startup
+from ingest import SCAN_CHUNK_SIZE, chunked, delete_scan_history, fill_missing_risks, ingest_scan
+import atexit
 import threading
 from uuid import uuid4
 from datetime import datetime, timedelta
+from itertools import chain
 
 LOG_DIR = "logs/pubsub"
-os.makedirs(LOG_DIR, exist_ok=True)
 
 def write_pubsub_log(message_data):
     """Write incoming Pub/Sub messages to a dated log file."""
     now = datetime.now()
+    os.makedirs(LOG_DIR, exist_ok=True)
     log_file_path = os.path.join(LOG_DIR, f"{now.strftime('%Y-%m-%d')}.log")
 
     with open(log_file_path, "a") as f:
@@ -27,7 +50,6 @@ def write_pubsub_log(message_data):
 # Enable Debugging for Logs
 DEBUG = True
 DROP_TABLES = False  # Temporarily set to True to recreate tables with new schem
-MAX_THREADS = os.cpu_count() - 1 if os.cpu_count() is not None else None
 
 # Set up logging
 import logging
@@ -44,6 +66,9 @@ logging.getLogger('google.api_core').setLevel(logging.WARNING)
 if DEBUG:
     logger.debug("Starting application in DEBUG mode")
 
+# Spans go nowhere unless TRACE_EXPORTER is set
+configure_tracing()
+
 # Load environment variables
 # load_dotenv() # NOTE: this is not needed when using docker compose env variables
 
@@ -51,35 +76,25 @@ if DEBUG:
 app = Flask(__name__)
 CORS(app)
 
+# Per-request profiling (X-Profile header); no hooks at all unless PROFILING_ENABLED
+install_profiler(app)
+
 # Database Connection
 DATABASE_URL = os.getenv("DB_URL", "mysql+mysqlconnector://user:password0@db:3306/dnstwist-db")
 if DEBUG:
     logger.debug(f"Connecting to database at: {DATABASE_URL}")
 
-# Add connection retry
-max_retries = 5
-retry_delay = 5  # seconds
-retries = 0
+# Engines connect on first use, so importing the app doesn't wait for MySQL;
+# the startup "database" step retries until it answers
+engine = create_db_engine(DATABASE_URL, API_ROLE)
 
-while retries < max_retries:
-    try:
-        logger.info(f"Attempt {retries + 1}/{max_retries} to connect to database...")
-        engine = create_engine(DATABASE_URL, pool_pre_ping=True)
-        # Test connection
-        with engine.connect() as conn:
-            logger.info("Database connection successful!")
-            break
-    except Exception as e:
-        retries += 1
-        logger.error(f"Database connection failed: {e}")
-        if retries < max_retries:
-            logger.info(f"Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-        else:
-            logger.error("Max retries reached. Could not connect to database.")
-            # Continue execution and let app fail later if needed
-            engine = create_engine(DATABASE_URL)
-            break
+# Scans get their own pool so they can't exhaust the connections request handlers need
+scan_db_engine = create_db_engine(DATABASE_URL, SCAN_ROLE)
+
+def check_database():
+    """Raises unless the database accepts connections."""
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
 
 # Ensure Database Schema Exists
 def create_db_and_tables():
@@ -89,13 +104,48 @@ def create_db_and_tables():
             logger.debug("Initializing database schema...")
         with engine.begin() as conn:
             SQLModel.metadata.create_all(conn)
+            add_missing_columns(conn)
+            add_missing_indexes(conn)
+            if filled := fill_missing_risks(conn):
+                logger.info(f"Filled in the missing risk of {filled} permutations")
         if DEBUG:
             logger.debug("Database schema initialized successfully.")
     except Exception as e:
         logger.error(f"Error initializing database schema: {e}")
         raise
 
-# Add this before create_db_and_tables() call
+def add_missing_columns(conn):
+    """Adds model columns missing from existing tables, since create_all only creates new tables."""
+    inspector = inspect(conn)
+    quote = conn.dialect.identifier_preparer.quote
+    for table in SQLModel.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            default = ""
+            if column.default is not None and column.default.is_scalar:
+                # Existing rows get the model default instead of NULL
+                value = literal(column.default.arg).compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+                default = f" DEFAULT {value}"
+            conn.execute(text(f"ALTER TABLE {quote(table.name)} ADD COLUMN {quote(column.name)} {column_type}{default}"))
+            logger.info(f"Added missing column {table.name}.{column.name}")
+
+def add_missing_indexes(conn):
+    """Creates model indexes missing from existing tables."""
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+def bump_scan_generation(session, user_id):
+    """Invalidates the user's ETags; atomic so concurrent scans can't both write the same generation."""
+    session.execute(
+        update(User).where(User.user_id == user_id).values(scan_generation=User.scan_generation + 1)
+    )
+
 def drop_all_tables():
     """Drops all tables to recreate schema."""
     try:
@@ -114,42 +164,67 @@ def drop_all_tables():
 os.environ["PUBSUB_EMULATOR_HOST"] = os.getenv("PUBSUB_EMULATOR_HOST", "localhost:8085")
 os.environ["GOOGLE_CLOUD_PROJECT"] = os.getenv("PUBSUB_PROJECT_ID", "your-project-id")
 
+class LazyClient:
+    """Builds a Pub/Sub client on first use, so importing the app opens no gRPC channel."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return getattr(self._client, name)
+
 # Initialize Pub/Sub clients
-publisher = pubsub_v1.PublisherClient()
-subscriber = pubsub_v1.SubscriberClient()
+publisher = LazyClient(pubsub_v1.PublisherClient)
+subscriber = LazyClient(pubsub_v1.SubscriberClient)
 
 # Topic and Subscription Names
 project_id = os.environ["GOOGLE_CLOUD_PROJECT"]
 topic_name = "frontend-to-backend"
 subscription_name = "backend-sub"
+PUBSUB_ADMIN_TIMEOUT = float(os.getenv("PUBSUB_ADMIN_TIMEOUT", "10"))  # Seconds for topic/subscription setup calls
 
-# Topic & Subscription Paths
-topic_path = publisher.topic_path(project_id, topic_name)
-subscription_path = subscriber.subscription_path(project_id, subscription_name)
+# Topic & Subscription Paths (plain string templates; no client needed)
+topic_path = pubsub_v1.PublisherClient.topic_path(project_id, topic_name)
+subscription_path = pubsub_v1.SubscriberClient.subscription_path(project_id, subscription_name)
 
 # Ensure Pub/Sub Topic Exists
 def ensure_topic():
+    """Creates the topic if needed; returns whether it exists now."""
     try:
-        topics = [t.name for t in publisher.list_topics(request={"project": f"projects/{project_id}"})]
+        topics = [t.name for t in publisher.list_topics(request={"project": f"projects/{project_id}"},
+                                                        timeout=PUBSUB_ADMIN_TIMEOUT)]
         if topic_path not in topics:
-            publisher.create_topic(request={"name": topic_path})
+            publisher.create_topic(request={"name": topic_path}, timeout=PUBSUB_ADMIN_TIMEOUT)
             logger.info(f"✅ Topic {topic_name} created.")
         else:
             logger.info(f"⚠️ Topic {topic_name} already exists.")
+        return True
     except Exception as e:
         logger.error(f"❌ Error creating topic: {e}")
+        return False
 
 # Ensure Pub/Sub Subscription Exists
 def ensure_subscription():
+    """Creates the subscription if needed; returns whether it exists now."""
     try:
-        subscriptions = [s.name for s in subscriber.list_subscriptions(request={"project": f"projects/{project_id}"})]
+        subscriptions = [s.name for s in subscriber.list_subscriptions(request={"project": f"projects/{project_id}"},
+                                                                       timeout=PUBSUB_ADMIN_TIMEOUT)]
         if subscription_path not in subscriptions:
-            subscriber.create_subscription(request={"name": subscription_path, "topic": topic_path})
+            subscriber.create_subscription(request={"name": subscription_path, "topic": topic_path},
+                                           timeout=PUBSUB_ADMIN_TIMEOUT)
             logger.info(f"✅ Subscription {subscription_name} created.")
         else:
             logger.info(f"⚠️ Subscription {subscription_name} already exists.")
+        return True
     except Exception as e:
         logger.error(f"❌ Error creating subscription: {e}")
+        return False
 
 @app.route('/publish-message', methods=['POST'])
 def publish_message():
@@ -161,8 +236,10 @@ def publish_message():
     message_data = data["message"].encode("utf-8")
 
     try:
-        future = publisher.publish(topic_path, message_data)
-        msg_id = future.result()
+        with tracer.start_as_current_span("pubsub.publish", kind=SpanKind.PRODUCER,
+                                          attributes={"messaging.destination": topic_path}):
+            future = publisher.publish(topic_path, message_data, **inject_context())
+            msg_id = future.result()
         logger.info(f"Published message: {msg_id}")
         return jsonify({"message": "Message published", "msg_id": msg_id})
     except Exception as e:
@@ -170,6 +247,25 @@ def publish_message():
         return jsonify({"error": str(e)}), 500
 
 def callback(message):
+    # Continues the trace of whoever published the message
+    with tracer.start_as_current_span("pubsub.consume", context=extract_context(message.attributes),
+                                      kind=SpanKind.CONSUMER,
+                                      attributes={"messaging.message_id": message.message_id,
+                                                  "message_type": message.attributes.get("type", "")}):
+        handle_message(message)
+
+def handle_message(message):
+    # Scan requests are run here; anything else is only logged
+    is_scan_request = message.attributes.get("type") == SCAN_REQUEST_TYPE
+    PUBSUB_MESSAGES_RECEIVED.inc(type=SCAN_REQUEST_TYPE if is_scan_request else "message")
+    if is_scan_request:
+        try:
+            handle_scan_message(message, scan_db_engine, run_permutation_scan)
+        except Exception as e:
+            logger.error(f"Error handling scan request: {e}")
+            message.nack()
+        return
+
     try:
         message_data = message.data.decode("utf-8")
         logger.info(f"📩 Received message: {message_data}")
@@ -182,22 +278,263 @@ def callback(message):
         logger.error(f"Error processing message: {e}")
 
 
+subscriber_stop = threading.Event()
+streaming_pull_future = None
+
 def start_subscriber():
     def run():
-        while True:
+        global streaming_pull_future
+        while not subscriber_stop.is_set():
+            # Pub/Sub may have come up (or been reset) since the last attempt
+            if not ensure_subscription():
+                subscriber_stop.wait(5)
+                continue
             try:
-                streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+                streaming_pull_future = subscriber.subscribe(
+                    subscription_path, callback=callback, flow_control=subscriber_flow_control()
+                )
+                if subscriber_stop.is_set():
+                    streaming_pull_future.cancel()  # stop_subscriber() ran while we were subscribing
                 logger.info("🔄 Listening for messages on subscription...")
                 streaming_pull_future.result()
             except Exception as e:
+                if subscriber_stop.is_set():
+                    break
                 logger.error(f"Subscriber error: {e}")
-                time.sleep(5)
+                subscriber_stop.wait(5)
 
-    thread = threading.Thread(target=run, daemon=True)
+    subscriber_stop.clear()
+    thread = threading.Thread(target=run, name="pubsub-subscriber", daemon=True)
     thread.start()
 
+def stop_subscriber():
+    """Stops pulling messages; unacked scan requests are redelivered to another subscriber."""
+    subscriber_stop.set()
+    if streaming_pull_future is not None:
+        streaming_pull_future.cancel()
+
+# ------------------------- Permutation Scans -------------------------
+
+def run_permutation_scan(user_id, root_domain):
+    """Runs dnstwist for a domain, stores the permutations and returns the scan summary."""
+    with tracer.start_as_current_span("scan", attributes={"user_id": user_id, "domain": root_domain}):
+        return scan_domain(user_id, root_domain)
+
+def scan_domain(user_id, root_domain):
+    scan_id = str(uuid4())
+    SCANS_IN_FLIGHT.inc()
+    try:
+        # Results arrive as a stream and are written in fixed-size chunks. The first
+        # chunk is awaited before opening a session so no DB connection sits idle
+        # while dnstwist runs.
+        results = timed_iter(scan_engine.scan(root_domain), SCAN_DNSTWIST_SECONDS, engine=scan_engine.name)
+        results = traced_iter(results, "dnstwist", engine=scan_engine.name, domain=root_domain)
+        chunks = chunked(results, SCAN_CHUNK_SIZE)
+        first_chunk = next(chunks, [])
+        
+        # use db session
+        with Session(scan_db_engine) as session:
+            # Plain existence checks; the counter rows aren't read or locked until the scan is written
+            domain = session.exec(select(Domain.domain_name).where(
+                (Domain.domain_name == root_domain) & 
+                (Domain.user_id == user_id)
+            )).first()
+            
+            if not domain:
+                raise ScanFailedError("Domain not found or doesn't belong to user")
+            
+            user = session.exec(select(User.user_id).where(User.user_id == user_id)).first()
+            if not user:
+                raise ScanFailedError("User not found")
+            
+            summary = ingest_scan(session, user_id, root_domain, scan_id, chain([first_chunk], chunks))
+            bump_scan_generation(session, user_id)
+            total_count = summary["total_permutations"]
+            processed_count = summary["processed_count"]
+            skipped_count = summary["skipped_count"]
+            changes = summary["changes"]
+            risk_levels = summary["risk_levels"]
+                        
+            # Commit all changes
+            with SCAN_COMMIT_SECONDS.time(), tracer.start_as_current_span("db.commit"):
+                session.commit()
+            response_cache.invalidate(user_tag(user_id), domain_tag(root_domain))
+            PERMUTATIONS_PROCESSED.inc(processed_count)
+            PERMUTATIONS_SKIPPED.inc(skipped_count)
+            
+            # Log permutation scan results to pubsub logs
+            log_data = json.dumps({
+                "type": "permutation_scan",
+                "timestamp": datetime.now().isoformat(),
+                "user_id": user_id,
+                "domain": root_domain,
+                "total_permutations": total_count,
+                "processed_count": processed_count,
+                "skipped_count": skipped_count,
+                "scan_id": scan_id,
+                "changes": changes,
+                "risk_levels": risk_levels,
+                "risk_counts": {
+                    "high": risk_levels["high"],
+                    "medium": risk_levels["medium"],
+                    "low": risk_levels["low"],
+                    "unknown": risk_levels["Unknown"]
+                }
+            })
+            write_pubsub_log(log_data)
+            
+            return {
+                "message": "Permutations processed successfully",
+                "domain": root_domain,
+                "total_permutations": total_count,
+                "processed_count": processed_count,
+                "skipped_count": skipped_count,
+                "scan_id": scan_id,
+                "changes": changes,
+                "risk_levels": risk_levels,
+                "domain_risk_counts": {
+                    "high": risk_levels["high"],
+                    "medium": risk_levels["medium"],
+                    "low": risk_levels["low"],
+                    "unknown": risk_levels["Unknown"]
+                }
+            }
+        
+    except ScanEngineError as e:
+        SCAN_FAILURES.inc(type="dnstwist")
+        logger.error(f"Error occurred: {e.details}")
+        
+        # Log errors to pubsub logs
+        error_log = json.dumps({
+            "type": "permutation_scan_error",
+            "timestamp": datetime.now().isoformat(),
+            "user_id": user_id,
+            "domain": root_domain,
+            "error": "Failed to execute dnstwist command",
+            "details": str(e.details)
+        })
+        write_pubsub_log(error_log)
+        
+        raise ScanFailedError("Failed to execute dnstwist command", str(e.details), retriable=True)
+    except ScanFailedError:
+        SCAN_FAILURES.inc(type="rejected")
+        raise
+    except Exception as e:
+        SCAN_FAILURES.inc(type="database")
+        logger.error(f"Database error occurred: {str(e)}")
+        
+        # Log database errors to pubsub logs
+        error_log = json.dumps({
+            "type": "permutation_db_error",
+            "timestamp": datetime.now().isoformat(),
+            "user_id": user_id,
+            "domain": root_domain,
+            "error": "Failed to process permutations",
+            "details": str(e)
+        })
+        write_pubsub_log(error_log)
+        
+        raise ScanFailedError("Failed to process permutations", str(e), retriable=True)
+    finally:
+        SCANS_IN_FLIGHT.dec()
+
+# One long-lived engine shared by all scan workers
+scan_engine = create_scan_engine()
+
+# Runs permutation scans off the request threads: on a local pool, or on
+# whichever backend/worker process pulls the request from Pub/Sub
+if SCAN_DISPATCH == "pubsub":
+    scan_jobs = PubSubScanDispatcher(engine, publisher, topic_path)
+else:
+    scan_jobs = ScanJobManager(run_permutation_scan)
+
+# Jobs waiting for a worker: in this process, or across all workers with Pub/Sub dispatch
+SCAN_QUEUE_DEPTH.set_function(scan_jobs.queued_count)
+
+# Runs due Schedule rows on the scan pool
+scheduler = ScanScheduler(scan_db_engine, scan_jobs, scan_engine.options_key())
+
+def invalidate_repaired_counts(user_id, domain_names):
+    response_cache.invalidate(user_tag(user_id), *(domain_tag(domain_name) for domain_name in domain_names))
+
+# Periodically repairs drift between the risk counters and the stored permutations
+count_reconciler = CountReconciler(scan_db_engine, on_repair=invalidate_repaired_counts)
+
+def start_background_services():
+    # Raising makes BackgroundOwner retry, instead of leaving queued scans without a subscriber
+    if SCAN_DISPATCH == "pubsub" and not ensure_subscription():
+        raise RuntimeError(f"Pub/Sub subscription {subscription_name} is unavailable")
+    start_subscriber()
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+    count_reconciler.start()
+
+def stop_background_services():
+    stop_subscriber()
+    if SCHEDULER_ENABLED:
+        scheduler.stop()
+    count_reconciler.stop()
+
+# Only the process holding the background lease runs the subscriber, scheduler and reconciler
+background_owner = BackgroundOwner(engine, start_background_services, stop_background_services)
+
+def prepare_pubsub():
+    if not ensure_topic():
+        raise RuntimeError(f"Pub/Sub topic {topic_name} is unavailable")
+
+def prepare_subscription():
+    if not ensure_subscription():
+        raise RuntimeError(f"Pub/Sub subscription {subscription_name} is unavailable")
+
+# Started by create_app() and run beside the server, so nothing waits on MySQL or Pub/Sub to come up
+startup = Startup()
+startup.add("database", check_database)
+startup.add("schema", create_db_and_tables, requires=["database"])
+# Scan requests are published to the topic with Pub/Sub dispatch; otherwise it only carries frontend messages
+startup.add("pubsub", prepare_pubsub, critical=SCAN_DISPATCH == "pubsub")
+startup.add("subscription", prepare_subscription, requires=["pubsub"], critical=SCAN_DISPATCH == "pubsub")
+# With Pub/Sub dispatch the subscriber is what runs scans, so it waits for the topic and subscription.
+# With local dispatch the scheduler and reconciler don't need Pub/Sub, and the subscriber
+# creates its subscription once Pub/Sub is reachable.
+startup.add("background", background_owner.start,
+            requires=["schema", "pubsub", "subscription"] if SCAN_DISPATCH == "pubsub" else ["schema"],
+            critical=False)
+
+# Encoded bodies of the scan-derived GET endpoints, dropped when their user or domain changes
+response_cache = create_cache()
+
 # ------------------------- API Endpoints -------------------------
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    # The route pattern, not the path, so per-user URLs share a series and span name
+    g.endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    g.request_span, g.request_span_token = start_server_span(
+        f"{request.method} {g.endpoint}", request.headers, **{"http.method": request.method, "http.route": g.endpoint}
+    )
+
+@app.after_request
+def observe_request_latency(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method, endpoint=g.endpoint,
+                                     status=response.status_code)
+        g.request_span.set_attribute("http.status_code", response.status_code)
+    return response
+
+@app.teardown_request
+def end_request_span(error):
+    span = g.pop("request_span", None)
+    if span is not None:
+        end_server_span(span, g.pop("request_span_token"), error)
+
+# Scan pipeline and request metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """API endpoint to expose scan timings, counts, failures and queue gauges to Prometheus."""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 
 @app.route("/")
 def health():
@@ -213,6 +550,32 @@ def health_check():
     else: # HEAD request
         return '', 204  # No Content for HEAD requests
 
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """API endpoint for readiness probes: 503 until the database, schema (and topic, with Pub/Sub dispatch) are ready."""
+    state = startup.state()
+    if state["ready"]:
+        # Startup got through once; make sure the database still answers
+        try:
+            check_database()
+        except Exception as e:
+            state["ready"] = False
+            state["database_error"] = str(e)
+    state["background"] = background_owner.stats()
+    return jsonify(state), 200 if state["ready"] else 503
+
+# Response cache counters, for sizing CACHE_MAX_ENTRIES / CACHE_MAX_BYTES
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """API endpoint to report response cache hits, misses and evictions."""
+    return jsonify(response_cache.stats()), 200
+
+# Connection pool telemetry, for sizing DB_POOL_SIZE / DB_MAX_OVERFLOW per role
+@app.route('/api/db/pool-stats', methods=['GET'])
+def db_pool_stats():
+    """API endpoint to report checked-out connections, overflow, checkout waits and timeouts per pool."""
+    return jsonify({API_ROLE: pool_stats(engine), SCAN_ROLE: pool_stats(scan_db_engine)}), 200
+
 # Describe the user table schema
 @app.route('/api/describe', methods=['GET'])
 def describe_user_table():
@@ -390,33 +753,50 @@ def domain_route(user_id):
             logger.debug(f"Received request to view domains for user: {user_id}")
         
         with Session(engine) as session:
-            user = session.exec(select(User).where(User.user_id == user_id)).first()
+            # Only the columns the response needs, as plain rows rather than ORM objects
+            user = session.exec(select(
+                User.high_risk_domains, User.medium_risk_domains, User.low_risk_domains, User.unknown_domains,
+                User.permutation_count, User.scan_generation
+            ).where(User.user_id == user_id)).first()
             
             if not user:
                 return jsonify({"error": "User not found"}), 404
-                
-            domains = session.exec(select(Domain).where(Domain.user_id == user_id)).all()
-            domain_list = [{
-                "domain_name": domain.domain_name, 
-                "total_scans": domain.total_scans,
-                "last_scan": domain.last_scan.isoformat() if domain.last_scan else None,
-                "risk_counts": {
-                    "high": domain.high_risk_domains,
-                    "medium": domain.medium_risk_domains,
-                    "low": domain.low_risk_domains,
-                    "unknown": domain.unknown_domains
+            
+            # Nothing changed since the client's copy: skip the domain query entirely
+            etag = make_etag("domains", user_id, user.scan_generation)
+            if (cached := not_modified(etag)) is not None:
+                return cached
+            
+            def build():
+                domains = session.exec(select(
+                    Domain.domain_name, Domain.total_scans, Domain.last_scan, Domain.permutation_count,
+                    Domain.high_risk_domains, Domain.medium_risk_domains, Domain.low_risk_domains, Domain.unknown_domains
+                ).where(Domain.user_id == user_id)).all()
+                domain_list = [{
+                    "domain_name": domain.domain_name, 
+                    "total_scans": domain.total_scans,
+                    "last_scan": domain.last_scan.isoformat() if domain.last_scan else None,
+                    "permutation_count": domain.permutation_count,
+                    "risk_counts": {
+                        "high": domain.high_risk_domains,
+                        "medium": domain.medium_risk_domains,
+                        "low": domain.low_risk_domains,
+                        "unknown": domain.unknown_domains
+                    }
+                } for domain in domains]
+                return {
+                    "domains": domain_list,
+                    "user_permutation_count": user.permutation_count,
+                    "user_risk_counts": {
+                        "high": user.high_risk_domains,
+                        "medium": user.medium_risk_domains,
+                        "low": user.low_risk_domains,
+                        "unknown": user.unknown_domains
+                    }
                 }
-            } for domain in domains]
             
-        return jsonify({
-            "domains": domain_list,
-            "user_risk_counts": {
-                "high": user.high_risk_domains,
-                "medium": user.medium_risk_domains,
-                "low": user.low_risk_domains,
-                "unknown": user.unknown_domains
-            }
-        }), 200
+            response = cached_json_response(response_cache, f"domains:{user_id}:{etag}", (user_tag(user_id),), build)
+        return with_etag(response, etag), 200
     
     elif request.method == 'DELETE':
         if DEBUG:
@@ -436,7 +816,7 @@ def domain_route(user_id):
             
         with Session(engine) as session:
             # Check if user exists
-            user = session.exec(select(User).where(User.user_id == user_id)).first()
+            user = session.exec(select(User.user_id).where(User.user_id == user_id)).first()
             if not user:
                 return jsonify({"error": "User not found"}), 404
                 
@@ -451,17 +831,16 @@ def domain_route(user_id):
             if not domain_to_delete:
                 return jsonify({"error": f"Domain '{domain_name}' not found for user {user_id}"}), 404
             
-            # Update user's risk counts before deleting the domain
-            user.high_risk_domains -= domain_to_delete.high_risk_domains
-            user.medium_risk_domains -= domain_to_delete.medium_risk_domains
-            user.low_risk_domains -= domain_to_delete.low_risk_domains
-            user.unknown_domains -= domain_to_delete.unknown_domains
-            session.add(user)
+            # Take the domain's counts out of the user's totals before deleting it
+            remove_domain_counts(session, user_id, domain_name)
+            bump_scan_generation(session, user_id)
+            delete_scan_history(session, domain_name)
                 
             # Delete the domain
             try:
                 session.delete(domain_to_delete)
                 session.commit()
+                response_cache.invalidate(user_tag(user_id), domain_tag(domain_name))
                 logger.debug(f"Successfully deleted domain: {domain_name} for user: {user_id}")
                 return jsonify({
                     "message": "Domain deleted successfully", 
@@ -500,14 +879,16 @@ def domain_route(user_id):
 
         new_domain = Domain(domain_name=domain_name, user_id=user_id, total_scans=0)
         session.add(new_domain)
+        bump_scan_generation(session, user_id)
         session.commit()
         session.refresh(new_domain)
+        response_cache.invalidate(user_tag(user_id))
 
         return jsonify({"message": "Domain added successfully", "domain_name": domain_name}), 201
 
 @app.route('/api/<user_id>/<domain_name>/permutations', methods=['POST', 'GET'])
 def handle_permutations(user_id, domain_name):
-    """Generates permutations using dnstwist and stores them in MySQL or fetches stored permutations for a given domain."""
+    """Queues a dnstwist permutation scan for a domain or fetches its stored permutations."""
     # Sanitize domain name to get just the root domain
     # root_domain = domain_name.split('/')[0]
     root_domain = domain_name
@@ -515,245 +896,164 @@ def handle_permutations(user_id, domain_name):
     if request.method == 'GET':
         if DEBUG:
             logger.debug(f"Received request to get permutations for domain {root_domain}")
+        
+        # Optional filters: ?risk_level=high,medium&fuzzer=homoglyph&min_risk=50
+        # Passing limit and/or cursor switches to keyset pagination ordered by risk (?order=asc|desc)
+        try:
+            risk_levels = [level for level in request.args.get('risk_level', '').split(',') if level]
+            fuzzer = request.args.get('fuzzer') or None
+            min_risk = float(request.args['min_risk']) if request.args.get('min_risk') else None
+            paginate = 'limit' in request.args or 'cursor' in request.args
+            limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+            cursor = request.args.get('cursor') or None
+            descending = request.args.get('order', 'desc').lower() != 'asc'
+        except ValueError:
+            return jsonify({"error": "limit must be an integer and min_risk a number"}), 400
+        
+        if not 1 <= limit <= MAX_PAGE_SIZE:
+            return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+        
+        # ?format=ndjson (or Accept: application/x-ndjson) streams one permutation per line,
+        # ?format=stream streams the usual response object; both read from a server-side cursor
+        stream_format = request.args.get('format')
+        if stream_format is None and request.accept_mimetypes.best == 'application/x-ndjson':
+            stream_format = 'ndjson'
+        if stream_format not in (None, 'json', 'ndjson', 'stream'):
+            return jsonify({"error": "format must be one of json, ndjson or stream"}), 400
+        if stream_format in ('ndjson', 'stream') and paginate:
+            return jsonify({"error": "Streaming can't be combined with limit or cursor"}), 400
             
         with Session(engine) as session:
             # Check if domain exists
-            domain = session.exec(select(Domain).where(
+            domain = session.exec(select(
+                Domain.high_risk_domains, Domain.medium_risk_domains, Domain.low_risk_domains, Domain.unknown_domains,
+                Domain.permutation_count, Domain.total_scans, Domain.last_scan
+            ).where(
                 (Domain.domain_name == root_domain) & 
                 (Domain.user_id == user_id)
             )).first()
             
             if not domain:
                 return jsonify({"error": "Domain not found or doesn't belong to user"}), 404
-                
-            # Get permutations for this domain
-            permutations = session.exec(
-                select(Permutation).where(Permutation.domain_name == root_domain)
-            ).all()
             
-            # Convert to serializable format with all fields
-            permutations_list = [
-                {
-                    "permutation_name": perm.permutation_name,
-                    "domain_name": perm.domain_name,
-                    "fuzzer": perm.fuzzer,
-                    "server": perm.server,
-                    "mail_server": perm.mail_server,
-                    "ip_address": perm.ip_address,
-                    "mx_spy": perm.mx_spy,
-                    "tlsh": perm.tlsh,
-                    "phash": perm.phash,
-                    "risk": perm.risk,
-                    "risk_level": perm.risk_level
+            filters = permutation_filters(root_domain, risk_levels, fuzzer, min_risk)
+            if stream_format in ('ndjson', 'stream'):
+                # No ETag: headers go out before the body is known to be complete, and
+                # a validator on a cut-short stream would let clients keep it via 304s
+                return stream_permutations(root_domain, filters, domain, stream_format)
+
+            # Permutations only change when a scan commits, which moves total_scans and last_scan;
+            # permutation_count also moves when the reconciler repairs the total a page reports
+            etag = make_etag("permutations", root_domain, domain.total_scans, domain.last_scan, domain.permutation_count,
+                             sorted(request.args.items(multi=True)), stream_format)
+            if (cached := not_modified(etag)) is not None:
+                return cached
+            
+            def build():
+                next_cursor = None
+                if paginate:
+                    permutations_list, next_cursor = permutation_page(session, filters, limit, cursor, descending)
+                else:
+                    # Get permutations for this domain, already in response shape
+                    permutations_list = permutation_rows(session, filters)
+                
+                risk_counts = {
+                    "high": domain.high_risk_domains,
+                    "medium": domain.medium_risk_domains,
+                    "low": domain.low_risk_domains,
+                    "unknown": domain.unknown_domains
                 }
-                for perm in permutations
-            ]
+                response = {
+                    "message": "Permutations retrieved successfully",
+                    "domain": root_domain,
+                    # A page reports the domain's stored total from its summary counter
+                    "total_permutations": domain.permutation_count if paginate else len(permutations_list),
+                    "permutations": permutations_list,
+                    "risk_counts": risk_counts
+                }
+                if paginate:
+                    response["next_cursor"] = next_cursor
+                return response
             
-        return jsonify({
-            "message": "Permutations retrieved successfully",
-            "domain": root_domain,
-            "total_permutations": len(permutations_list),
-            "permutations": permutations_list,
-            "risk_counts": {
-                "high": domain.high_risk_domains,
-                "medium": domain.medium_risk_domains,
-                "low": domain.low_risk_domains,
-                "unknown": domain.unknown_domains
-            }
-        }), 200
+            try:
+                response = cached_json_response(response_cache, f"permutations:{root_domain}:{etag}",
+                                                (user_tag(user_id), domain_tag(root_domain)), build)
+            except ValueError as e:
+                # Malformed cursor
+                return jsonify({"error": str(e)}), 400
+        return with_etag(response, etag), 200
     
     if request.method == 'POST':
         if DEBUG:
             logger.debug(f"Received request to generate permutations for domain {root_domain}")
 
+        # Validate up front so the client gets a 404 instead of a failed job
+        with Session(engine) as session:
+            domain = session.exec(select(Domain).where(
+                (Domain.domain_name == root_domain) & 
+                (Domain.user_id == user_id)
+            )).first()
+            
+            if not domain:
+                return jsonify({"error": "Domain not found or doesn't belong to user"}), 404
 
-        # actual command for dnstwist
-        command = [
-            'dnstwist', 
-            '--lsh', 'tlsh',
-            '--phash', 
-            '--threads', str(MAX_THREADS),
-            '--mx', 
-            '--banner', 
-            '--registered',
-            '--format', 'json',
-            f'{root_domain}'
-        ]
-
+        # ?force=true skips reusing a recently finished scan (in-flight scans are still shared)
+        force = request.args.get('force', 'false').lower() == 'true'
         try:
-            result = subprocess.run(command, capture_output=True, text=True, check=True)
-            obj = json.loads(result.stdout)
-            
-            # use db session
-            with Session(engine) as session:
-                # Get domain and user objects for updating
-                domain = session.exec(select(Domain).where(
-                    (Domain.domain_name == root_domain) & 
-                    (Domain.user_id == user_id)
-                )).first()
-                
-                if not domain:
-                    return jsonify({"error": "Domain not found or doesn't belong to user"}), 404
-                
-                user = session.exec(select(User).where(User.user_id == user_id)).first()
-                if not user:
-                    return jsonify({"error": "User not found"}), 404
-                
-                # Delete existing permutations for this domain
-                existing_permutations = session.exec(
-                    select(Permutation).where(Permutation.domain_name == root_domain)
-                ).all()
-                
-                for perm in existing_permutations:
-                    session.delete(perm)
-                
-                # Reset domain risk counts before adding new ones
-                user.high_risk_domains -= domain.high_risk_domains
-                user.medium_risk_domains -= domain.medium_risk_domains
-                user.low_risk_domains -= domain.low_risk_domains
-                user.unknown_domains -= domain.unknown_domains
-                
-                domain.high_risk_domains = 0
-                domain.medium_risk_domains = 0
-                domain.low_risk_domains = 0
-                domain.unknown_domains = 0
-                
-                processed_count = 0
-                skipped_count = 0
-                risk_levels = {"Unknown": 0, "low": 0, "medium": 0, "high": 0}
-                
-                # Process new permutations
-                for permutation in obj:
-                    if (permutation.get('tlsh') and permutation.get('phash')) is None:
-                        skipped_count += 1
-                        continue
-                    if (permutation.get('dns_a') is None) or (permutation.get('dns_a') == "!ServFail"):
-                        skipped_count += 1
-                        continue
-                    else:
-                        # max scores of tlsh and phash
-                        risk = max(permutation.get('tlsh', 0), permutation.get('phash', 0))
-                        
-                        # classify risk levels
-                        if risk == 0:
-                            risk_level = "Unknown"
-                            domain.unknown_domains += 1
-                        elif risk <= 25:
-                            risk_level = "low"
-                            domain.low_risk_domains += 1
-                        elif risk <= 50:
-                            risk_level = "medium"
-                            domain.medium_risk_domains += 1
-                        else:
-                            risk_level = "high"
-                            domain.high_risk_domains += 1
-                            
-                        risk_levels[risk_level] += 1
-                            
-                        perm = Permutation(
-                            permutation_name=permutation['domain'],
-                            domain_name=root_domain,
-                            fuzzer=permutation.get('fuzzer', ''),
-                            server=permutation.get('banner_http'),
-                            mail_server=permutation.get('dns_mx', [None])[0] if permutation.get('dns_mx') else None,
-                            ip_address=permutation.get('dns_a', [None])[0] if permutation.get('dns_a') else None,
-                            mx_spy=permutation.get('mx_spy'),
-                            tlsh=permutation.get('tlsh'),
-                            phash=permutation.get('phash'),
-                            risk=risk,
-                            risk_level=risk_level
-                        )
-                        # Add to session
-                        session.add(perm)
-                        processed_count += 1
-                
-                # Update the domain's last scan time
-                domain.last_scan = datetime.now()
-                domain.total_scans += 1
-                
-                # Update user's aggregate risk counts
-                user.high_risk_domains += domain.high_risk_domains
-                user.medium_risk_domains += domain.medium_risk_domains
-                user.low_risk_domains += domain.low_risk_domains
-                user.unknown_domains += domain.unknown_domains
-                
-                # Update the domain record
-                session.add(domain)
-                session.add(user)
-                            
-                # Commit all changes
-                session.commit()
-                
-                # Log permutation scan results to pubsub logs
-                log_data = json.dumps({
-                    "type": "permutation_scan",
-                    "timestamp": datetime.now().isoformat(),
-                    "user_id": user_id,
-                    "domain": root_domain,
-                    "total_permutations": len(obj),
-                    "processed_count": processed_count,
-                    "skipped_count": skipped_count,
-                    "risk_levels": risk_levels,
-                    "risk_counts": {
-                        "high": domain.high_risk_domains,
-                        "medium": domain.medium_risk_domains,
-                        "low": domain.low_risk_domains,
-                        "unknown": domain.unknown_domains
-                    }
-                })
-                write_pubsub_log(log_data)
-                
-                return jsonify({
-                    "message": "Permutations processed successfully",
-                    "domain": root_domain,
-                    "total_permutations": len(obj),
-                    "processed_count": processed_count,
-                    "skipped_count": skipped_count,
-                    "risk_levels": risk_levels,
-                    "domain_risk_counts": {
-                        "high": domain.high_risk_domains,
-                        "medium": domain.medium_risk_domains,
-                        "low": domain.low_risk_domains,
-                        "unknown": domain.unknown_domains
-                    }
-                }), 201
-            
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error occurred: {e.stderr}")
-            
-            # Log errors to pubsub logs
-            error_log = json.dumps({
-                "type": "permutation_scan_error",
-                "timestamp": datetime.now().isoformat(),
-                "user_id": user_id,
-                "domain": root_domain,
-                "error": "Failed to execute dnstwist command",
-                "details": str(e.stderr)
-            })
-            write_pubsub_log(error_log)
-            
-            return jsonify({
-                "error": "Failed to execute dnstwist command",
-                "details": str(e.stderr)
-            }), 500
-        except Exception as e:
-            logger.error(f"Database error occurred: {str(e)}")
-            
-            # Log database errors to pubsub logs
-            error_log = json.dumps({
-                "type": "permutation_db_error",
-                "timestamp": datetime.now().isoformat(),
-                "user_id": user_id,
-                "domain": root_domain,
-                "error": "Failed to process permutations",
-                "details": str(e)
-            })
-            write_pubsub_log(error_log)
-            
-            return jsonify({
-                "error": "Failed to process permutations",
-                "details": str(e)
-            }), 500
+            job, created = scan_jobs.submit(user_id, root_domain, scan_engine.options_key(), reuse_fresh=not force)
+        except QueueFullError as e:
+            logger.warning(f"Rejected scan for domain {root_domain}: {e}")
+            return jsonify({"error": str(e)}), 503
+
+        return jsonify({
+            "message": "Permutation scan queued" if created else "Attached to existing permutation scan",
+            "job_id": job.job_id,
+            "status": job.status,
+            "coalesced": not created,
+            "domain": root_domain,
+            "status_url": f"/api/{user_id}/scan-jobs/{job.job_id}"
+        }), 202
+
+def stream_permutations(root_domain, filters, domain, stream_format):
+    """Streams a domain's permutations without holding them in memory.
+
+    The generator opens its own session, since the response body is produced
+    after the view returns.
+    """
+    def rows():
+        with Session(engine) as session:
+            try:
+                yield from iter_permutation_rows(session, filters, STREAM_BATCH_SIZE)
+            except Exception as e:
+                # Headers are already sent, so re-raise: the server aborts the connection and the
+                # client gets an unterminated body instead of a well-formed but truncated one
+                logger.error(f"Failed while streaming permutations for domain {root_domain}: {e}")
+                raise
+
+    if stream_format == 'ndjson':
+        return Response(ndjson_chunks(rows()), mimetype='application/x-ndjson')
+
+    head = {
+        "message": "Permutations retrieved successfully",
+        "domain": root_domain,
+        "risk_counts": {
+            "high": domain.high_risk_domains,
+            "medium": domain.medium_risk_domains,
+            "low": domain.low_risk_domains,
+            "unknown": domain.unknown_domains
+        }
+    }
+    return Response(json_object_chunks(head, "permutations", rows(), "total_permutations"),
+                    mimetype='application/json')
+
+@app.route('/api/<user_id>/scan-jobs/<job_id>', methods=['GET'])
+def scan_job_status(user_id, job_id):
+    """API endpoint to report the status of a queued permutation scan."""
+    job = scan_jobs.get(job_id)
+    if not job or job.user_id != user_id:
+        return jsonify({"error": "Scan job not found"}), 404
+
+    return jsonify(record_to_dict(job) if isinstance(job, ScanJobRecord) else job.to_dict()), 200
 
 @app.route('/api/<user_id>/schedule', methods=['POST'])
 def schedule_domain(user_id):
@@ -781,63 +1081,62 @@ def schedule_domain(user_id):
 
     with Session(engine) as session:
         # Check if user exists
-        user = session.exec(select(User).where(User.user_id == user_id)).first()
+        user = session.exec(select(User.user_id).where(User.user_id == user_id)).first()
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        # Calculate start and next scan times with proper MySQL 8.0 datetime format
-        start_date = datetime.now().replace(microsecond=0)  # Remove microseconds for MySQL compatibility
-        next_scan = (start_date + timedelta(hours=hours)).replace(microsecond=0)
-
-        created_schedules = []
+        # Validate every domain with one IN query instead of a lookup per name
+        owned_domains = set(session.exec(
+            select(Domain.domain_name).where(
+                (Domain.user_id == user_id) &
+                Domain.domain_name.in_(domain_names)
+            )
+        ).all())
         for domain_name in domain_names:
-            # Check if domain exists and belongs to user
-            domain = session.exec(
-                select(Domain).where(
-                    (Domain.domain_name == domain_name) & 
-                    (Domain.user_id == user_id)
-                )
-            ).first()
-            
-            if not domain:
+            if domain_name not in owned_domains:
                 return jsonify({"error": f"Domain '{domain_name}' not found or doesn't belong to user"}), 404
 
-            try:
-                # Create new schedule with explicit datetime format
-                logger.debug(f"Start date: {start_date.strftime('%Y-%m-%d %H:%M:%S')}")
-                logger.debug(f"Next scan: {next_scan.strftime('%Y-%m-%d %H:%M:%S')}")
-                schedule = Schedule(
-                    user_id=user_id,
-                    domain_name=domain_name,
-                    start_date=start_date.strftime('%Y-%m-%d %H:%M:%S'),
-                    next_scan=next_scan.strftime('%Y-%m-%d %H:%M:%S'), # format for MySQL 8.0
-                    schedule_name=f"Scan for {domain_name}"
-                )
-                
-                session.add(schedule)
-                session.flush()  # Flush to get the schedule_id
-                
-                created_schedules.append({
-                    "schedule_id": schedule.schedule_id,
-                    "domain_name": domain_name,
-                    "next_scan": next_scan.strftime('%Y-%m-%d %H:%M:%S')  # Format for MySQL 8.0
-                })
-            except Exception as e:
-                logger.error(f"Error creating schedule for domain {domain_name}: {str(e)}")
-                session.rollback()
-                return jsonify({"error": f"Failed to create schedule: {str(e)}"}), 500
+        # Calculate start time with proper MySQL 8.0 datetime format
+        start_date = datetime.now().replace(microsecond=0)  # Remove microseconds for MySQL compatibility
+        interval = timedelta(hours=hours)
+
+        rows = []
+        for domain_name in domain_names:
+            # Each schedule gets its own offset into the interval so they don't all fire at once
+            schedule_id = str(uuid4())
+            rows.append({
+                "schedule_id": schedule_id,
+                "user_id": user_id,
+                "domain_name": domain_name,
+                "start_date": start_date,
+                "next_scan": slot_after(schedule_id, start_date, interval, start_date).replace(microsecond=0),
+                "interval_hours": hours,
+                "schedule_name": f"Scan for {domain_name}",
+                "lease_owner": None,
+                "lease_expires_at": None,
+            })
 
         try:
+            # One statement for the whole batch; the driver sends it as multi-row VALUES
+            session.execute(insert(Schedule), rows)
             session.commit()
-            return jsonify({
-                "message": "Schedules created successfully",
-                "schedules": created_schedules
-            }), 201
         except Exception as e:
             logger.error(f"Error committing schedules: {str(e)}")
             session.rollback()
             return jsonify({"error": f"Failed to commit schedules: {str(e)}"}), 500
 
+        return jsonify({
+            "message": "Schedules created successfully",
+            "schedules": [
+                {
+                    "schedule_id": row["schedule_id"],
+                    "domain_name": row["domain_name"],
+                    "next_scan": row["next_scan"].strftime('%Y-%m-%d %H:%M:%S')  # Format for MySQL 8.0
+                }
+                for row in rows
+            ]
+        }), 201
+
 
 @app.route('/api/<user_id>/schedule', methods=['GET','DELETE','PATCH'])
 def schedule_route(user_id):
@@ -848,13 +1147,15 @@ def schedule_route(user_id):
             
         with Session(engine) as session:
             # Check if user exists
-            user = session.exec(select(User).where(User.user_id == user_id)).first()
+            user = session.exec(select(User.user_id).where(User.user_id == user_id)).first()
             if not user:
                 return jsonify({"error": "User not found"}), 404
                 
             # Get all schedules for the user
             schedules = session.exec(
-                select(Schedule).where(Schedule.user_id == user_id)
+                select(Schedule.schedule_id, Schedule.schedule_name, Schedule.domain_name,
+                       Schedule.start_date, Schedule.next_scan)
+                .where(Schedule.user_id == user_id)
             ).all()
             
             # Convert to serializable format
@@ -869,7 +1170,7 @@ def schedule_route(user_id):
                 for schedule in schedules
             ]
             
-            return jsonify({"schedules": schedules_list}), 200
+            return json_response({"schedules": schedules_list}), 200
 
     elif request.method == 'DELETE':
         if DEBUG:
@@ -889,23 +1190,27 @@ def schedule_route(user_id):
             if not user:
                 return jsonify({"error": "User not found"}), 404
                 
-            deleted_schedules = []
-            for schedule_id in schedule_ids:
-                schedule = session.exec(
-                    select(Schedule).where(
-                        (Schedule.schedule_id == schedule_id) & 
-                        (Schedule.user_id == user_id)
-                    )
-                ).first()
-                
-                if schedule:
-                    session.delete(schedule)
-                    deleted_schedules.append(schedule_id)
+            # Which of the ids belong to this user, then one set-based DELETE for all of them
+            owned = session.exec(
+                select(Schedule.schedule_id, Schedule.domain_name).where(
+                    Schedule.schedule_id.in_(schedule_ids) & 
+                    (Schedule.user_id == user_id)
+                )
+            ).all()
+            deleted_schedules = [schedule.schedule_id for schedule in owned]
+            affected_domains = {schedule.domain_name for schedule in owned}
                     
             if not deleted_schedules:
                 return jsonify({"error": "No valid schedules found to delete"}), 404
-                
+            
+            session.execute(
+                delete(Schedule).where(
+                    Schedule.schedule_id.in_(deleted_schedules) & 
+                    (Schedule.user_id == user_id)
+                )
+            )
             session.commit()
+            response_cache.invalidate(*(domain_tag(domain_name) for domain_name in affected_domains))
             return jsonify({
                 "message": "Schedules deleted successfully",
                 "deleted_schedules": deleted_schedules
@@ -968,6 +1273,40 @@ def schedule_route(user_id):
                 }
             }), 200
 
+@app.route('/api/schedule/plan', methods=['GET'])
+def schedule_plan():
+    """API endpoint to project scheduled scan load per time bucket, optionally for a single user."""
+    try:
+        horizon_hours = int(request.args.get('hours', 24))
+        bucket_minutes = int(request.args.get('bucket_minutes', 60))
+    except ValueError:
+        return jsonify({"error": "hours and bucket_minutes must be integers"}), 400
+    
+    if not 1 <= horizon_hours <= 168:
+        return jsonify({"error": "hours must be between 1 and 168"}), 400
+    if not 1 <= bucket_minutes <= horizon_hours * 60:
+        return jsonify({"error": "bucket_minutes must be between 1 and the horizon"}), 400
+    
+    user_id = request.args.get('user_id')
+    with Session(engine) as session:
+        query = select(Schedule)
+        if user_id:
+            query = query.where(Schedule.user_id == user_id)
+        schedules = session.exec(query).all()
+    
+    start = datetime.now().replace(second=0, microsecond=0)
+    buckets = plan_scan_load(schedules, start, timedelta(hours=horizon_hours), timedelta(minutes=bucket_minutes))
+    scan_counts = [bucket["scans"] for bucket in buckets]
+    
+    return jsonify({
+        "schedules": len(schedules),
+        "hours": horizon_hours,
+        "bucket_minutes": bucket_minutes,
+        "total_scans": sum(scan_counts),
+        "peak_scans": max(scan_counts),
+        "buckets": buckets
+    }), 200
+
 @app.route('/api/<user_id>/permutations-count', methods=['GET'])
 def count_user_permutations(user_id):
     """API endpoint to count the number of permutations for a user."""
@@ -975,48 +1314,64 @@ def count_user_permutations(user_id):
         logger.debug(f"Received request to count permutations for user: {user_id}")
 
     with Session(engine) as session:
-        # Check if user exists
-        user = session.exec(select(User).where(User.user_id == user_id)).first()
+        # The user's summary counters answer this with a single primary-key lookup
+        user = session.exec(select(
+            User.permutation_count, User.high_risk_domains, User.medium_risk_domains, User.low_risk_domains,
+            User.unknown_domains, User.scan_generation
+        ).where(User.user_id == user_id)).first()
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        # Get all domains for the user
-        user_domains = session.exec(
-            select(Domain.domain_name).where(Domain.user_id == user_id)
-        ).all()
-
-        if not user_domains:
-            return jsonify({
-                "count": 0, 
-                "risk_counts": {
-                    "high": 0,
-                    "medium": 0,
-                    "low": 0,
-                    "unknown": 0
-                }
-            }), 200
-
-        # Count permutations for all user's domains using a subquery
-        total_count = session.exec(
-            select(text("COUNT(*)")).select_from(
-                select(Permutation).where(Permutation.domain_name.in_(user_domains))
-            )
-        ).first()
+    etag = make_etag("permutations-count", user_id, user.scan_generation)
+    if (cached := not_modified(etag)) is not None:
+        return cached
 
-        return jsonify({
-            "count": total_count, 
-            "risk_counts": {
-                "high": user.high_risk_domains,
-                "medium": user.medium_risk_domains,
-                "low": user.low_risk_domains,
-                "unknown": user.unknown_domains
-            }
-        }), 200
+    return with_etag(json_response({
+        "count": user.permutation_count, 
+        "risk_counts": {
+            "high": user.high_risk_domains,
+            "medium": user.medium_risk_domains,
+            "low": user.low_risk_domains,
+            "unknown": user.unknown_domains
+        }
+    }), etag), 200
 
 # ------------------------- Startup Sequence -------------------------
 
+_started = False
+_startup_lock = threading.Lock()
+
+def create_app():
+    """Starts the startup steps in the background and returns the WSGI app without waiting for them.
+
+    Safe to call from every worker of a multi-process server: startup runs once
+    per process, and only the elected process runs the background services.
+    GET /api/ready reports when the app can take traffic.
+    """
+    global _started
+    with _startup_lock:
+        if not _started:
+            startup.start()
+            REGISTRY.start_sharing()
+            _started = True
+    return app
+
+def shutdown():
+    """Stops the background services (handing the lease to another process) and the local scan pool."""
+    global _started
+    with _startup_lock:
+        if not _started:
+            return
+        _started = False
+    startup.stop()
+    background_owner.stop()
+    if isinstance(scan_jobs, ScanJobManager):
+        scan_jobs.shutdown(wait=False)
+    REGISTRY.stop_sharing()
+    logger.info("Shutdown complete")
+
 if __name__ == '__main__':
-    time.sleep(1)
+    # Development server only; production runs `gunicorn -c gunicorn.conf.py wsgi:app`
     # Drop all tables to recreate schema
     if DROP_TABLES:
         try:
@@ -1024,8 +1379,6 @@ if __name__ == '__main__':
         except Exception as e:
             logger.error(f"Error dropping tables: {e}")
     
-    create_db_and_tables()
-    ensure_topic()
-    ensure_subscription()
-    start_subscriber()
+    create_app()
+    atexit.register(shutdown)
     app.run(host='0.0.0.0', port=8000, debug=True)
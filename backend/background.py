@@ -0,0 +1,148 @@
+"""Elects the one process that runs the background services.
+
+Under a multi-worker server every worker imports the app, but the Pub/Sub
+subscriber, the scheduler and the count reconciler should only run once.
+Workers compete for a row in the servicelease table. The holder starts the
+services and renews the lease while it runs. Everyone else retries every
+BACKGROUND_RENEW_SECONDS, so a worker that dies is replaced within
+BACKGROUND_LEASE_SECONDS. A worker that shuts down cleanly releases the
+lease straight away.
+
+BACKGROUND_ROLE: "auto" (elect through the lease, the default), "always" (run
+the services without electing, e.g. a dedicated worker) or "never" (serve
+requests only).
+"""
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from uuid import uuid4
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+from models import ServiceLease
+
+logger = logging.getLogger(__name__)
+
+BACKGROUND_ROLE = os.getenv("BACKGROUND_ROLE", "auto")  # "auto", "always" or "never"
+BACKGROUND_LEASE_SECONDS = int(os.getenv("BACKGROUND_LEASE_SECONDS", "30"))  # Takeover delay after the owner dies
+BACKGROUND_RENEW_SECONDS = int(os.getenv("BACKGROUND_RENEW_SECONDS", "10"))  # How often the lease is renewed or tried
+
+BACKGROUND_LEASE_NAME = "background"
+
+
+class BackgroundOwner:
+    """Runs `start_services` while this process holds the background lease, and `stop_services` when it loses it."""
+
+    def __init__(self, engine, start_services: Callable[[], None], stop_services: Callable[[], None],
+                 role: str = BACKGROUND_ROLE, lease_seconds: int = BACKGROUND_LEASE_SECONDS,
+                 renew_seconds: int = BACKGROUND_RENEW_SECONDS, name: str = BACKGROUND_LEASE_NAME):
+        if role not in ("auto", "always", "never"):
+            raise ValueError(f"Unknown background role: {role}")
+        self.engine = engine
+        self.start_services = start_services
+        self.stop_services = stop_services
+        self.role = role
+        self.lease = timedelta(seconds=lease_seconds)
+        self.renew_seconds = renew_seconds
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.running = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.role == "never":
+            logger.info("Background services disabled in this process (BACKGROUND_ROLE=never)")
+        elif self.role == "always":
+            self._start_services()
+        else:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="background-owner", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stops the services if this process runs them and hands the lease to the next process."""
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread:
+            thread.join()
+        self._stop_services()
+        if thread is not None:  # Only an electing process ever held the lease
+            try:
+                self._release()
+            except Exception as e:
+                logger.error(f"Failed to release background lease: {e}")
+
+    def stats(self) -> dict:
+        return {"role": self.role, "owner": self.owner, "running": self.running}
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                held = self._acquire()
+            except Exception as e:
+                # Without the database we can't prove the lease is still ours
+                logger.error(f"Background lease check failed: {e}")
+                held = False
+            if held and not self.running:
+                logger.info(f"Process {self.owner} took the background lease")
+                self._start_services()
+            elif not held and self.running:
+                logger.warning(f"Process {self.owner} lost the background lease")
+                self._stop_services()
+            self._stop.wait(self.renew_seconds)
+
+    def _start_services(self):
+        try:
+            self.start_services()
+            self.running = True
+        except Exception as e:
+            logger.error(f"Failed to start background services: {e}")
+            self._stop_services(force=True)
+
+    def _stop_services(self, force: bool = False):
+        if not (self.running or force):
+            return
+        self.running = False
+        try:
+            self.stop_services()
+        except Exception as e:
+            logger.error(f"Failed to stop background services: {e}")
+
+    def _acquire(self) -> bool:
+        """Takes or renews the lease; True when this process holds it afterwards."""
+        now = datetime.now()
+        with Session(self.engine) as session:
+            if session.get(ServiceLease, self.name) is None:
+                try:
+                    session.add(ServiceLease(name=self.name))
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()  # Another process created the row first
+            # One conditional UPDATE, so two processes can't both take an expired lease
+            result = session.execute(
+                update(ServiceLease)
+                .where((ServiceLease.name == self.name) & (
+                    (ServiceLease.owner == self.owner)
+                    | ServiceLease.owner.is_(None)
+                    | ServiceLease.expires_at.is_(None)
+                    | (ServiceLease.expires_at <= now)
+                ))
+                .values(owner=self.owner, expires_at=now + self.lease)
+            )
+            session.commit()
+            return result.rowcount == 1
+
+    def _release(self):
+        with Session(self.engine) as session:
+            session.execute(
+                update(ServiceLease)
+                .where((ServiceLease.name == self.name) & (ServiceLease.owner == self.owner))
+                .values(owner=None, expires_at=None)
+            )
+            session.commit()
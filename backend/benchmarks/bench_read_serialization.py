@@ -0,0 +1,87 @@
+"""Compares the legacy ORM + jsonify read path with column projection + orjson.
+
+Measures the permutations listing at each size: load the domain's rows,
+build the response dicts and encode the JSON body. Reports total time and
+per-row cost.
+
+Usage (from backend/):
+    python benchmarks/bench_read_serialization.py [--sizes 10000 100000] [--db-url URL] [--repeat N]
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask import Flask, jsonify  # noqa: E402
+from sqlmodel import Session, delete, select  # noqa: E402
+
+from models import Permutation  # noqa: E402
+from queries import permutation_filters, permutation_rows  # noqa: E402
+from serialization import json_response  # noqa: E402
+
+from fixtures import ROOT_DOMAIN, generate_results  # noqa: E402
+from harness import best_of, create_bench_engine, ingest_results, reset_database  # noqa: E402
+
+
+def legacy_read(engine):
+    """The original GET path: full ORM entities, a hand-built dict per row, Flask's jsonify."""
+    with Session(engine) as session:
+        permutations = session.exec(select(Permutation).where(Permutation.domain_name == ROOT_DOMAIN)).all()
+        permutations_list = [
+            {
+                "permutation_name": perm.permutation_name,
+                "domain_name": perm.domain_name,
+                "fuzzer": perm.fuzzer,
+                "server": perm.server,
+                "mail_server": perm.mail_server,
+                "ip_address": perm.ip_address,
+                "mx_spy": perm.mx_spy,
+                "tlsh": perm.tlsh,
+                "phash": perm.phash,
+                "risk": perm.risk,
+                "risk_level": perm.risk_level
+            }
+            for perm in permutations
+        ]
+    return jsonify({"permutations": permutations_list}).get_data()
+
+
+def projected_read(engine):
+    """The current GET path: selected columns only, tuples zipped into dicts, orjson."""
+    with Session(engine) as session:
+        permutations_list = permutation_rows(session, permutation_filters(ROOT_DOMAIN))
+    return json_response({"permutations": permutations_list}).get_data()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--db-url", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    engine = create_bench_engine(args.db_url)
+    user_id = reset_database(engine)
+
+    # jsonify needs an application context
+    app = Flask(__name__)
+
+    print(f"database: {engine.url.render_as_string(hide_password=True)}")
+    print(f"{'rows':>8} {'legacy (s)':>11} {'us/row':>7} {'projected (s)':>14} {'us/row':>7} {'speedup':>8}")
+    with app.app_context():
+        for size in args.sizes:
+            with Session(engine) as session:
+                session.exec(delete(Permutation))
+                session.commit()
+            ingest_results(engine, user_id, generate_results(size))
+
+            assert len(legacy_read(engine)) > 0 and len(projected_read(engine)) > 0
+            legacy = best_of(args.repeat, legacy_read, engine)
+            projected = best_of(args.repeat, projected_read, engine)
+            print(f"{size:>8} {legacy:>11.3f} {legacy / size * 1e6:>7.1f} "
+                  f"{projected:>14.3f} {projected / size * 1e6:>7.1f} {legacy / projected:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
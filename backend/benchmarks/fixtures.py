@@ -0,0 +1,47 @@
+"""Synthetic dnstwist output for the benchmarks.
+
+Generates results shaped like `dnstwist --format json --registered --mx
+--banner --lsh tlsh --phash`: fuzzer, domain, dns_a, dns_mx, banner_http, tlsh
+and phash. The output only depends on the count, seed and change rate, so
+every run (and every commit) benchmarks the same input. A few results lack a
+tlsh or phash or resolve to !ServFail, the way real scans do, so the skip
+path is exercised too.
+"""
+import json
+import os
+import sys
+from typing import Iterator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scan_engine import simulated_results  # noqa: E402
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".fixtures")
+ROOT_DOMAIN = "example.com"
+
+
+def generate_results(count: int, seed: int = 0, changed_every: int = 0,
+                     root_domain: str = ROOT_DOMAIN) -> Iterator[dict]:
+    """Yields `count` dnstwist results for `root_domain`, from the same simulator as SCAN_ENGINE=fake."""
+    return simulated_results(root_domain, count, seed, changed_every)
+
+
+def write_fixture(path: str, count: int, seed: int = 0, changed_every: int = 0) -> None:
+    """Writes the results as one JSON array, a result at a time, so large fixtures don't sit in memory."""
+    with open(path, "w") as f:
+        f.write("[\n")
+        for i, result in enumerate(generate_results(count, seed, changed_every)):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(result))
+        f.write("\n]\n")
+
+
+def fixture_path(count: int, seed: int = 0, changed_every: int = 0, directory: str = FIXTURE_DIR) -> str:
+    """Path of the fixture for these parameters, generating it on first use."""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"dnstwist-{count}-seed{seed}-changed{changed_every}.json")
+    if not os.path.exists(path):
+        write_fixture(path + ".tmp", count, seed, changed_every)
+        os.replace(path + ".tmp", path)
+    return path
@@ -0,0 +1,84 @@
+"""Setup and timing shared by the benchmarks.
+
+create_bench_engine() opens --db-url or a throwaway SQLite file,
+reset_database() recreates the schema with one user owning the benchmark
+domains, ingest_results() seeds permutations through the scan write path, and
+best_of()/timed() time a call. bench_app() imports the backend app against the
+benchmark database, so endpoints can be driven through app.test_client()
+instead of copies of their queries.
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Iterable, Optional
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sqlmodel import SQLModel, Session, create_engine  # noqa: E402
+
+from ingest import chunked, ingest_scan  # noqa: E402
+from models import User, Domain  # noqa: E402
+
+from fixtures import ROOT_DOMAIN  # noqa: E402
+
+
+def create_bench_engine(db_url: Optional[str] = None):
+    """Engine for `db_url`, or for a fresh SQLite file in a temporary directory."""
+    return create_engine(db_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.sqlite')}")
+
+
+def reset_database(engine, domain_names: Iterable[str] = (ROOT_DOMAIN,)) -> str:
+    """Fresh schema with one user owning `domain_names`; returns the user id."""
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        user = User(username="bench")
+        session.add(user)
+        session.flush()
+        session.add_all(Domain(domain_name=domain_name, user_id=user.user_id) for domain_name in domain_names)
+        session.commit()
+        return user.user_id
+
+
+def ingest_results(engine, user_id: str, results: Iterable[dict], domain_name: str = ROOT_DOMAIN) -> None:
+    """Stores dnstwist results for a domain the way a finished scan does, and commits."""
+    with Session(engine) as session:
+        ingest_scan(session, user_id, domain_name, str(uuid4()), chunked(results))
+        session.commit()
+
+
+def measure(func: Callable, *args) -> tuple[float, object]:
+    """Runs func once; returns the seconds it took and what it returned."""
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def timed(func: Callable, *args) -> float:
+    return measure(func, *args)[0]
+
+
+def best_of(repeat: int, func: Callable, *args) -> float:
+    """The fastest of `repeat` runs, which is the least disturbed by everything else on the machine."""
+    return min(timed(func, *args) for _ in range(repeat))
+
+
+def bench_app(engine):
+    """The backend's Flask app, reading and writing the benchmark database.
+
+    DB_URL and CACHE_BACKEND are read when the app module is imported, so this
+    must run before anything else imports it. The response cache is off, so
+    repeated requests time the handler instead of cache hits. Startup and the
+    background services are not started; requests only need the schema,
+    which reset_database() creates.
+    """
+    os.environ["DB_URL"] = engine.url.render_as_string(hide_password=False)
+    os.environ["CACHE_BACKEND"] = "none"
+    import app as backend
+
+    # Per-request debug logging would be timed along with the requests
+    logging.getLogger(backend.__name__).setLevel(logging.WARNING)
+    return backend.app
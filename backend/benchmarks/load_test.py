@@ -0,0 +1,238 @@
+"""HTTP load generator for the API, meant to run against a backend started with SCAN_ENGINE=fake.
+
+Creates --users users with --domains domains each, then runs --concurrency
+virtual users for --duration seconds. Each one repeatedly picks an action
+from a weighted mix (seeded, so runs are repeatable):
+    scan       POST .../permutations?force=true, then poll the job until it finishes
+    dashboard  GET the domain list and the permutation count, revalidating with ETags
+    listing    GET the first page of a domain's permutations
+    schedule   create a schedule, rename it, then delete it
+
+Reports throughput and p50/p90/p99/max latency per request type, plus
+end-to-end scan time, and writes them as JSON (default
+benchmarks/results/load-<time>.json).
+
+Usage (from backend/):
+    SCAN_ENGINE=fake FAKE_SCAN_LATENCY_SECONDS=2 python app.py   # in another shell
+    python benchmarks/load_test.py [--base-url http://localhost:8000] [--duration 60] [--concurrency 20]
+                                   [--mix scan=1,dashboard=6,listing=2,schedule=1]
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import requests
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+DEFAULT_MIX = "scan=1,dashboard=6,listing=2,schedule=1"
+SCAN_POLL_SECONDS = 0.5
+SCAN_TIMEOUT_SECONDS = 600
+SCAN_END_TO_END = "scan_end_to_end"  # Recorded per finished scan, not per HTTP request
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Recorder:
+    """Latencies and errors per request type, shared by all virtual users."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def request(self, session, name, method, url, ok=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=60, **kwargs)
+        except requests.RequestException:
+            with self._lock:
+                self.errors[name] += 1
+            return None
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies[name].append(elapsed)
+            self.statuses[name][response.status_code] += 1
+            if response.status_code not in ok:
+                self.errors[name] += 1
+        return response
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.latencies[name].append(seconds)
+
+    def fail(self, name):
+        with self._lock:
+            self.errors[name] += 1
+
+    def summary(self, duration):
+        report = {}
+        for name in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[name])
+            report[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "per_second": round(len(values) / duration, 3),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1) if values else None,
+                "p90_ms": round(percentile(values, 0.90) * 1000, 1) if values else None,
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1) if values else None,
+                "max_ms": round(values[-1] * 1000, 1) if values else None,
+                "statuses": dict(self.statuses[name]),
+            }
+        return report
+
+
+def setup_users(base_url, users, domains):
+    """Creates the users and their domains; returns [(user_id, [domain_name, ...]), ...]."""
+    accounts = []
+    with requests.Session() as session:
+        for u in range(users):
+            response = session.post(f"{base_url}/api/user", json={"username": f"load-user-{u}"}, timeout=30)
+            response.raise_for_status()
+            user_id = response.json()["user_id"]
+            names = [f"load{u}-{d}.example" for d in range(domains)]
+            for name in names:
+                session.post(f"{base_url}/api/{user_id}/domain", json={"domain_name": name},
+                             timeout=30).raise_for_status()
+            accounts.append((user_id, names))
+    return accounts
+
+
+class VirtualUser(threading.Thread):
+    def __init__(self, index, base_url, accounts, mix, deadline, recorder, seed):
+        super().__init__(name=f"load-{index}", daemon=True)
+        self.base_url = base_url
+        self.accounts = accounts
+        self.actions, self.weights = zip(*mix.items())
+        self.deadline = deadline
+        self.recorder = recorder
+        self.rng = random.Random(f"{seed}:{index}")
+        self.etags = {}
+
+    def run(self):
+        with requests.Session() as session:
+            while time.monotonic() < self.deadline:
+                user_id, domains = self.rng.choice(self.accounts)
+                action = self.rng.choices(self.actions, self.weights)[0]
+                getattr(self, action)(session, user_id, self.rng.choice(domains))
+
+    def get_with_etag(self, session, name, url):
+        headers = {"If-None-Match": self.etags[url]} if url in self.etags else {}
+        response = self.recorder.request(session, name, "GET", url, ok=(200, 304), headers=headers)
+        if response is not None and response.headers.get("ETag"):
+            self.etags[url] = response.headers["ETag"]
+
+    def scan(self, session, user_id, domain):
+        started = time.perf_counter()
+        response = self.recorder.request(session, "scan_submit", "POST",
+                                         f"{self.base_url}/api/{user_id}/{domain}/permutations?force=true",
+                                         ok=(202,))
+        if response is None or response.status_code != 202:
+            return
+        status_url = self.base_url + response.json()["status_url"]
+        while time.perf_counter() - started < SCAN_TIMEOUT_SECONDS:
+            time.sleep(SCAN_POLL_SECONDS)
+            status = self.recorder.request(session, "scan_status", "GET", status_url)
+            if status is None or status.status_code != 200:
+                continue
+            job_status = status.json()["status"]
+            if job_status == "done":
+                self.recorder.record(SCAN_END_TO_END, time.perf_counter() - started)
+                return
+            if job_status == "failed":
+                self.recorder.fail(SCAN_END_TO_END)
+                return
+        self.recorder.fail(SCAN_END_TO_END)
+
+    def dashboard(self, session, user_id, domain):
+        self.get_with_etag(session, "dashboard_domains", f"{self.base_url}/api/{user_id}/domain")
+        self.get_with_etag(session, "dashboard_count", f"{self.base_url}/api/{user_id}/permutations-count")
+
+    def listing(self, session, user_id, domain):
+        self.get_with_etag(session, "permutations_page",
+                           f"{self.base_url}/api/{user_id}/{domain}/permutations?limit=100")
+
+    def schedule(self, session, user_id, domain):
+        url = f"{self.base_url}/api/{user_id}/schedule"
+        created = self.recorder.request(session, "schedule_create", "POST", url,
+                                        json={"hours": self.rng.randint(1, 168), "domain_names": [domain]},
+                                        ok=(201,))
+        if created is None or created.status_code != 201:
+            return
+        schedule_id = created.json()["schedules"][0]["schedule_id"]
+        self.recorder.request(session, "schedule_update", "PATCH", url,
+                              json={"schedule_id": schedule_id, "schedule_name": f"load {domain}"})
+        self.recorder.request(session, "schedule_delete", "DELETE", url, json={"schedule_ids": [schedule_id]})
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ("scan", "dashboard", "listing", "schedule"):
+            raise argparse.ArgumentTypeError(f"Unknown action in mix: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--domains", type=int, default=5, help="domains per user")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    base_url = args.base_url.rstrip("/")
+    print(f"setting up {args.users} users x {args.domains} domains on {base_url}")
+    accounts = setup_users(base_url, args.users, args.domains)
+
+    recorder = Recorder()
+    started = time.monotonic()
+    workers = [VirtualUser(i, base_url, accounts, args.mix, started + args.duration, recorder, args.seed)
+               for i in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # Scans still being polled at the deadline finish first, so measure the real elapsed time
+    duration = time.monotonic() - started
+
+    summary = recorder.summary(duration)
+    print(f"\n{'request':<20} {'count':>7} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8}")
+    for name, row in summary.items():
+        cells = [row[key] if row[key] is not None else "-" for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms")]
+        print(f"{name:<20} {row['count']:>7} {row['errors']:>7} {row['per_second']:>8} "
+              + " ".join(f"{cell:>8}" for cell in cells))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "created_at": datetime.now().isoformat(),
+            "parameters": {key: value for key, value in vars(args).items() if key != "output"},
+            "duration_seconds": round(duration, 3),
+            "requests_per_second": round(
+                sum(row["count"] for name, row in summary.items() if name != SCAN_END_TO_END) / duration, 3),
+            "results": summary,
+        }, f, indent=2)
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
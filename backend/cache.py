@@ -0,0 +1,209 @@
+"""Response cache for the scan-derived read endpoints.
+
+Entries are encoded response bodies tagged with the user and domain they
+were built from. Writers call invalidate() with those tags when a scan
+commits or a domain or schedule goes away. Keys also carry the endpoint's
+ETag validator, so a replica that missed an invalidation (e.g. a scan
+committed by a Pub/Sub worker) can never serve a stale body.
+
+CACHE_BACKEND picks the implementation: "memory" (per-process LRU, the
+default), "redis" (shared between replicas, needs the redis package and
+CACHE_REDIS_URL) or "none".
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")  # "memory", "redis" or "none"
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "300"))  # Upper bound on an entry's life
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))  # Total size of cached bodies
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+
+def user_tag(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def domain_tag(domain_name: str) -> str:
+    return f"domain:{domain_name}"
+
+
+class NullCache:
+    """Caches nothing; CACHE_BACKEND=none."""
+
+    name = "none"
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: bytes, tags: tuple = ()) -> None:
+        pass
+
+    def invalidate(self, *tags: str) -> int:
+        return 0
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+class MemoryCache(NullCache):
+    """In-process LRU bounded by entry count and total bytes, with a TTL per entry."""
+
+    name = "memory"
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, max_bytes: int = CACHE_MAX_BYTES,
+                 ttl: int = CACHE_TTL_SECONDS):
+        super().__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[bytes, float, tuple]] = OrderedDict()  # key -> (value, expires, tags)
+        self._tags: dict[str, set[str]] = {}  # tag -> keys carrying it
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value: bytes, tags: tuple = ()) -> None:
+        # One body may not take over more than an eighth of the cache
+        if len(value) > self.max_bytes // 8:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + self.ttl, tags)
+            self._bytes += len(value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *tags: str) -> int:
+        with self._lock:
+            keys = set().union(*(self._tags.get(tag, ()) for tag in tags))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(super().stats(), entries=len(self._entries), bytes=self._bytes,
+                        max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+    def _remove(self, key: str) -> None:
+        """Drops one entry and its tag references. Caller holds the lock."""
+        value, _, tags = self._entries.pop(key)
+        self._bytes -= len(value)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class RedisCache(NullCache):
+    """Cache shared by every replica. Redis does the TTL and memory eviction (configure maxmemory-policy)."""
+
+    name = "redis"
+
+    def __init__(self, url: str = CACHE_REDIS_URL, ttl: int = CACHE_TTL_SECONDS):
+        import redis
+
+        super().__init__()
+        self.ttl = ttl
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            value = self._client.get(f"cache:{key}")
+        except Exception as e:
+            logger.warning(f"Cache read failed: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes, tags: tuple = ()) -> None:
+        try:
+            pipe = self._client.pipeline()
+            pipe.set(f"cache:{key}", value, ex=self.ttl)
+            for tag in tags:
+                pipe.sadd(f"cache-tag:{tag}", key)
+                pipe.expire(f"cache-tag:{tag}", self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Cache write failed: {e}")
+
+    def invalidate(self, *tags: str) -> int:
+        try:
+            keys = set()
+            for tag in tags:
+                keys.update(key.decode() for key in self._client.smembers(f"cache-tag:{tag}"))
+            pipe = self._client.pipeline()
+            for key in keys:
+                pipe.delete(f"cache:{key}")
+            pipe.delete(*(f"cache-tag:{tag}" for tag in tags))
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Cache invalidation failed: {e}")
+            return 0
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        try:
+            stats["evictions"] = self._client.info("stats").get("evicted_keys", 0)
+        except Exception as e:
+            logger.warning(f"Could not read cache stats: {e}")
+        return stats
+
+
+def create_cache(name: str = CACHE_BACKEND):
+    if name == "none":
+        return NullCache()
+    if name == "redis":
+        try:
+            return RedisCache()
+        except ImportError:
+            logger.warning("redis package not installed, using the in-process cache")
+    return MemoryCache()
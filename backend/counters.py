@@ -0,0 +1,242 @@
+"""Risk counters on Domain and User.
+
+Domain.*_risk_domains and Domain.permutation_count hold the risk-level
+breakdown and total of the domain's stored permutations, so the Domain and
+User rows double as the per-domain and per-user summary the read endpoints
+look up by primary key. User.* hold the sum over the user's domains. Scans
+and domain deletes adjust them with in-database `x = x + :delta` updates at
+the very end of their transaction, so concurrent scans for one user can't
+overwrite each other's counts. reconcile_risk_counts() recomputes everything
+from Permutation with GROUP BY and repairs any drift; run it periodically
+(RECONCILE_INTERVAL_MINUTES) or once with `python counters.py`.
+"""
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy import bindparam, func, update
+from sqlmodel import Session, select
+
+from models import User, Domain, Permutation
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL_MINUTES = int(os.getenv("RECONCILE_INTERVAL_MINUTES", "60"))  # 0 disables the periodic job
+
+# Permutation.risk_level -> counter column on Domain and User
+RISK_COUNT_COLUMNS = {
+    "high": "high_risk_domains",
+    "medium": "medium_risk_domains",
+    "low": "low_risk_domains",
+    "Unknown": "unknown_domains",
+}
+PERMUTATION_COUNT_COLUMN = "permutation_count"
+COUNT_COLUMNS = [*RISK_COUNT_COLUMNS.values(), PERMUTATION_COUNT_COLUMN]
+
+
+def _user_delta(user_id: str, deltas: dict):
+    """UPDATE user SET col = col + :delta for every non-zero delta."""
+    return (
+        update(User)
+        .where(User.user_id == user_id)
+        .values({getattr(User, column): getattr(User, column) + delta for column, delta in deltas.items()})
+    )
+
+
+def record_domain_scan(session: Session, user_id: str, domain_name: str, risk_levels: dict,
+                       permutation_count: int, scanned_at: datetime) -> None:
+    """Stores a finished scan's counts on the domain and moves the user's totals by the difference.
+
+    Meant to run right before the scan commits: the domain row is locked only
+    from here to the commit, and the user row is only touched by an atomic
+    increment.
+    """
+    new_counts = {column: risk_levels.get(level, 0) for level, column in RISK_COUNT_COLUMNS.items()}
+    new_counts[PERMUTATION_COUNT_COLUMN] = permutation_count
+    old = session.exec(
+        select(*(getattr(Domain, column) for column in new_counts))
+        .where(Domain.domain_name == domain_name)
+        .with_for_update()
+    ).one()
+
+    session.execute(
+        update(Domain)
+        .where(Domain.domain_name == domain_name)
+        .values(last_scan=scanned_at, total_scans=Domain.total_scans + 1, **new_counts)
+    )
+    deltas = {column: new_counts[column] - previous for column, previous in zip(new_counts, old)}
+    if any(deltas.values()):
+        session.execute(_user_delta(user_id, deltas))
+
+
+def remove_domain_counts(session: Session, user_id: str, domain_name: str) -> None:
+    """Takes a domain that's about to be deleted out of its user's totals."""
+    columns = COUNT_COLUMNS
+    counts = session.exec(
+        select(*(getattr(Domain, column) for column in columns))
+        .where(Domain.domain_name == domain_name)
+        .with_for_update()
+    ).first()
+    if counts is not None and any(counts):
+        session.execute(_user_delta(user_id, {column: -count for column, count in zip(columns, counts)}))
+
+
+def _permutation_counts(session: Session, domain_names: Optional[list] = None) -> dict[str, dict]:
+    """Counter values computed from Permutation with GROUP BY, for the given domains or all of them."""
+    columns = COUNT_COLUMNS
+    statement = select(Permutation.domain_name, Permutation.risk_level, func.count())
+    if domain_names is not None:
+        statement = statement.where(Permutation.domain_name.in_(domain_names))
+    actual: dict[str, dict] = {}
+    for domain_name, risk_level, count in session.exec(
+        statement.group_by(Permutation.domain_name, Permutation.risk_level)
+    ):
+        counts = actual.setdefault(domain_name, dict.fromkeys(columns, 0))
+        counts[PERMUTATION_COUNT_COLUMN] += count
+        if risk_level in RISK_COUNT_COLUMNS:
+            counts[RISK_COUNT_COLUMNS[risk_level]] = count
+    return actual
+
+
+def _drifted_users(session: Session) -> list[str]:
+    """Users whose own or domains' counters disagree with Permutation in an unlocked snapshot."""
+    columns = COUNT_COLUMNS
+    actual = _permutation_counts(session)
+    drifted = set()
+    user_totals: dict[str, dict] = {}
+    for row in session.exec(select(Domain.domain_name, Domain.user_id, *(getattr(Domain, c) for c in columns))):
+        counts = actual.get(row.domain_name, dict.fromkeys(columns, 0))
+        if any(getattr(row, column) != counts[column] for column in columns):
+            drifted.add(row.user_id)
+        totals = user_totals.setdefault(row.user_id, dict.fromkeys(columns, 0))
+        for column in columns:
+            totals[column] += counts[column]
+
+    for row in session.exec(select(User.user_id, *(getattr(User, c) for c in columns))):
+        totals = user_totals.get(row.user_id, dict.fromkeys(columns, 0))
+        if any(getattr(row, column) != totals[column] for column in columns):
+            drifted.add(row.user_id)
+    return sorted(drifted)
+
+
+def _repair_user(session: Session, user_id: str) -> tuple[list[str], bool]:
+    """Recomputes one user's counters under row locks; returns (domain names repaired, user repaired).
+
+    The user's domain rows are locked first and then the user row, the same
+    order record_domain_scan() and remove_domain_counts() take them in. A scan
+    that hasn't committed yet waits for us and then applies its delta on top of
+    the repaired values, and one that already committed is in what we count.
+    """
+    columns = COUNT_COLUMNS
+    domains = session.exec(
+        select(Domain.domain_name, *(getattr(Domain, c) for c in columns))
+        .where(Domain.user_id == user_id)
+        .order_by(Domain.domain_name)
+        .with_for_update()
+    ).all()
+    user = session.exec(
+        select(*(getattr(User, c) for c in columns)).where(User.user_id == user_id).with_for_update()
+    ).first()
+    if user is None:
+        return [], False
+
+    actual = _permutation_counts(session, [row.domain_name for row in domains]) if domains else {}
+    totals = dict.fromkeys(columns, 0)
+    domain_fixes = []
+    for row in domains:
+        counts = actual.get(row.domain_name, dict.fromkeys(columns, 0))
+        if any(getattr(row, column) != counts[column] for column in columns):
+            domain_fixes.append(dict(counts, b_domain_name=row.domain_name))
+        for column in columns:
+            totals[column] += counts[column]
+
+    if domain_fixes:
+        session.execute(
+            update(Domain.__table__).where(Domain.__table__.c.domain_name == bindparam("b_domain_name")),
+            domain_fixes,
+        )
+    user_drifted = any(getattr(user, column) != totals[column] for column in columns)
+    if user_drifted or domain_fixes:
+        # A new generation so the user's cached responses and ETags, which show these counts, go stale
+        session.execute(
+            update(User).where(User.user_id == user_id)
+            .values(scan_generation=User.scan_generation + 1, **totals)
+        )
+    return [fix["b_domain_name"] for fix in domain_fixes], user_drifted
+
+
+def reconcile_risk_counts(engine, on_repair: Optional[Callable[[str, list[str]], None]] = None) -> dict:
+    """Recomputes every domain's and user's counters from Permutation and repairs the ones that drifted.
+
+    An unlocked pass finds the users that look wrong; each of them is then
+    recomputed and written in its own transaction with their rows locked, so
+    the repair can't overwrite a scan that commits in between. After each
+    repair commits, on_repair(user_id, repaired domain names) is called, e.g.
+    to drop cached responses that show the old counts.
+    """
+    with Session(engine) as session:
+        suspects = _drifted_users(session)
+
+    domains_repaired = users_repaired = 0
+    for user_id in suspects:
+        with Session(engine) as session:
+            domains, user = _repair_user(session, user_id)
+            session.commit()
+        if on_repair is not None and (domains or user):
+            on_repair(user_id, domains)
+        domains_repaired += len(domains)
+        users_repaired += user
+
+    if domains_repaired or users_repaired:
+        logger.warning(f"Repaired risk counts of {domains_repaired} domains and {users_repaired} users")
+    return {"domains_repaired": domains_repaired, "users_repaired": users_repaired}
+
+
+class CountReconciler:
+    """Runs reconcile_risk_counts() on start and then every `interval_minutes` on a daemon thread.
+
+    The first pass always runs, since it also backfills counter columns added to
+    an existing schema; `interval_minutes` <= 0 only turns off the repeats.
+    """
+
+    def __init__(self, engine, interval_minutes: int = RECONCILE_INTERVAL_MINUTES,
+                 on_repair: Optional[Callable[[str, list[str]], None]] = None):
+        self.engine = engine
+        self.interval_minutes = interval_minutes
+        self.on_repair = on_repair
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="count-reconciler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        # The first pass also backfills counter columns added to an existing schema
+        while True:
+            try:
+                reconcile_risk_counts(self.engine, self.on_repair)
+            except Exception as e:
+                logger.error(f"Risk count reconciliation failed: {e}")
+            if self.interval_minutes <= 0 or self._stop.wait(self.interval_minutes * 60):
+                break
+
+
+def main():
+    """Reconciles once and prints what was repaired."""
+    from app import engine
+
+    print(reconcile_risk_counts(engine))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Database engines with configurable connection pools and pool telemetry.
+
+Request handlers and background scan work (the local scan pool, Pub/Sub scan
+deliveries, the scheduler and the count reconciler) get separate engines, so
+a burst of scans can't take the connections the API needs. Each pool reads
+its settings from the environment, role-specific first and then the shared
+default, e.g. SCAN_DB_POOL_SIZE, then DB_POOL_SIZE:
+
+    DB_POOL_SIZE       connections kept open (default 5)
+    DB_MAX_OVERFLOW    extra connections opened under load (default 10)
+    DB_POOL_TIMEOUT    seconds a checkout waits for a free connection (default 30)
+    DB_POOL_RECYCLE    seconds before a connection is replaced, -1 never (default 1800)
+    DB_POOL_PRE_PING   test connections on checkout (default true)
+
+pool_stats() reports checked-out connections, overflow, checkout wait times
+and timeouts for an engine.
+"""
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from sqlmodel import create_engine
+
+logger = logging.getLogger(__name__)
+
+API_ROLE = "api"
+SCAN_ROLE = "scan"
+
+POOL_DEFAULTS = {
+    "POOL_SIZE": "5",
+    "MAX_OVERFLOW": "10",
+    "POOL_TIMEOUT": "30",
+    "POOL_RECYCLE": "1800",
+    "POOL_PRE_PING": "true",
+}
+
+
+def _setting(role: str, name: str) -> str:
+    return os.getenv(f"{role.upper()}_DB_{name}") or os.getenv(f"DB_{name}", POOL_DEFAULTS[name])
+
+
+def pool_settings(role: str) -> dict:
+    """create_engine() pool arguments for a role, from the environment."""
+    return {
+        "pool_size": int(_setting(role, "POOL_SIZE")),
+        "max_overflow": int(_setting(role, "MAX_OVERFLOW")),
+        "pool_timeout": float(_setting(role, "POOL_TIMEOUT")),
+        "pool_recycle": int(_setting(role, "POOL_RECYCLE")),
+        "pool_pre_ping": _setting(role, "POOL_PRE_PING").lower() == "true",
+    }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that also counts checkouts, time spent waiting for a connection and checkout timeouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            checkouts, timeouts = self.checkouts, self.timeouts
+            wait_seconds, max_wait_seconds = self.wait_seconds, self.max_wait_seconds
+        return {
+            "size": self.size(),
+            "max_overflow": self._max_overflow,
+            "timeout": self._timeout,
+            "checked_out": self.checkedout(),
+            "idle": self.checkedin(),
+            "overflow": max(0, self.overflow()),
+            "checkouts": checkouts,
+            "checkout_timeouts": timeouts,
+            "wait_seconds_total": round(wait_seconds, 6),
+            "wait_seconds_avg": round(wait_seconds / checkouts, 6) if checkouts else 0.0,
+            "wait_seconds_max": round(max_wait_seconds, 6),
+        }
+
+
+def create_db_engine(url: str, role: str = API_ROLE):
+    """Engine for one role, with that role's pool settings."""
+    if make_url(url).get_backend_name() == "sqlite":
+        # SQLite picks its own pool; sizing it makes no sense
+        return create_engine(url)
+    settings = pool_settings(role)
+    logger.info(f"Creating {role} database pool: {settings}")
+    return create_engine(url, poolclass=InstrumentedQueuePool, **settings)
+
+
+def pool_stats(engine) -> dict:
+    """Current telemetry of an engine's pool."""
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {"status": pool.status()}
@@ -0,0 +1,58 @@
+"""Gunicorn settings for serving the backend: `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+Every worker builds the app and joins the background election (see
+background.py), so exactly one of them runs the Pub/Sub subscriber, the
+scheduler and the count reconciler. On SIGTERM workers stop accepting
+connections, finish in-flight requests for up to GRACEFUL_TIMEOUT seconds,
+and then release the background lease so another process takes over.
+
+Several workers need SCAN_DISPATCH=pubsub: with local dispatch a scan's status
+only exists in the worker that queued it, so local dispatch runs one worker and
+refuses to start with more. Workers share their metrics through METRICS_DIR,
+so /metrics reports the whole server whichever worker answers.
+"""
+import os
+import tempfile
+
+SCAN_DISPATCH = os.getenv("SCAN_DISPATCH", "local")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+# Processes; each has its own API and scan DB pools
+workers = int(os.getenv("WEB_CONCURRENCY", "4" if SCAN_DISPATCH == "pubsub" else "1"))
+worker_class = "gthread"  # Threads, since requests mostly wait on MySQL and responses may stream
+threads = int(os.getenv("WEB_THREADS", "8"))  # Requests a worker serves at once
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))  # A silent worker is restarted after this long
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))  # Time in-flight requests get on shutdown
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+accesslog = os.getenv("ACCESS_LOG", "-")
+# The app is imported in each worker, not the master, so no DB connection or gRPC channel crosses a fork
+preload_app = False
+
+# Set before any worker is forked, so they all inherit it
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "fuzzify-metrics"))
+
+
+def on_starting(server):
+    if workers > 1 and SCAN_DISPATCH != "pubsub":
+        raise RuntimeError(
+            f"WEB_CONCURRENCY={workers} needs SCAN_DISPATCH=pubsub: with local dispatch a scan's status is "
+            "only visible to the worker that queued it"
+        )
+    from metrics import clear_shared
+
+    # Counters left by a previous run would otherwise be added to this one's
+    clear_shared(os.environ["METRICS_DIR"])
+
+
+def child_exit(server, worker):
+    # Runs in the master for every worker that exits, including ones killed on timeout
+    from metrics import mark_process_dead
+
+    mark_process_dead(worker.pid, os.environ["METRICS_DIR"])
+
+
+def worker_exit(server, worker):
+    # Runs after the worker stopped serving; hands the background lease to a surviving process
+    from app import shutdown
+
+    shutdown()
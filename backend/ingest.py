@@ -0,0 +1,301 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlmodel import Session
+
+from counters import record_domain_scan
+from metrics import SCAN_INGEST_SECONDS
+from models import Permutation, ScanHistory
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+SCAN_CHUNK_SIZE = int(os.getenv("SCAN_CHUNK_SIZE", "500"))  # Permutations written per flush
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "500"))  # Rows per multi-row INSERT statement
+SCAN_HISTORY_RETENTION_DAYS = int(os.getenv("SCAN_HISTORY_RETENTION_DAYS", "90"))  # 0 keeps history forever
+
+RISK_LEVELS = ("Unknown", "low", "medium", "high")
+# Stored instead of a NULL risk, which keyset pages over (risk, permutation_name) would skip; sorts below every score
+MISSING_RISK = -1.0
+
+# Columns compared against the stored row to decide whether a permutation changed
+DIFF_FIELDS = ("ip_address", "mail_server", "server", "tlsh", "phash")
+HISTORY_FIELDS = DIFF_FIELDS + ("risk", "risk_level")
+
+
+def chunked(iterable: Iterable, size: int = SCAN_CHUNK_SIZE) -> Iterator[list]:
+    """Yields lists of at most `size` items without materializing the iterable."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def classify_risk(risk) -> str:
+    """Maps a 0-100 similarity score to a risk level."""
+    if risk == 0:
+        return "Unknown"
+    elif risk <= 25:
+        return "low"
+    elif risk <= 50:
+        return "medium"
+    return "high"
+
+
+def build_permutation_row(permutation: dict, root_domain: str) -> Optional[dict]:
+    """Turns one dnstwist result into Permutation column values, or None if it should be skipped."""
+    if (permutation.get('tlsh') and permutation.get('phash')) is None:
+        return None
+    dns_a = permutation.get('dns_a')
+    # dnstwist reports a failed lookup as ["!ServFail"] in its JSON output
+    if (dns_a is None) or (dns_a == "!ServFail") or (isinstance(dns_a, list) and "!ServFail" in dns_a):
+        return None
+
+    # max scores of tlsh and phash
+    risk = max(permutation.get('tlsh') or 0, permutation.get('phash') or 0)
+
+    return {
+        "permutation_name": permutation['domain'],
+        "domain_name": root_domain,
+        "fuzzer": permutation.get('fuzzer', ''),
+        "server": permutation.get('banner_http'),
+        "mail_server": permutation.get('dns_mx', [None])[0] if permutation.get('dns_mx') else None,
+        "ip_address": permutation.get('dns_a', [None])[0] if permutation.get('dns_a') else None,
+        "mx_spy": permutation.get('mx_spy'),
+        "tlsh": permutation.get('tlsh'),
+        "phash": permutation.get('phash'),
+        "risk": risk,
+        "risk_level": classify_risk(risk),
+    }
+
+
+def fill_missing_risks(conn) -> int:
+    """Gives permutations stored with a NULL risk (by older versions) MISSING_RISK; returns the rows updated."""
+    result = conn.execute(update(Permutation).where(Permutation.risk.is_(None)).values(risk=MISSING_RISK))
+    return result.rowcount
+
+
+def upsert_permutations(session: Session, rows: list[dict], batch_size: int = UPSERT_BATCH_SIZE) -> None:
+    """Writes permutation rows with batched INSERT ... ON DUPLICATE KEY UPDATE (or the dialect equivalent).
+
+    permutation_name is the primary key across all domains, so an existing row
+    is only updated when it belongs to the same domain; a row owned by another
+    domain is left alone rather than moved.
+    """
+    if not rows:
+        return
+
+    table = Permutation.__table__
+    dialect = session.get_bind().dialect.name
+    update_columns = [column for column in rows[0] if column not in ("permutation_name", "domain_name")]
+
+    if dialect in ("mysql", "mariadb"):
+        statement = mysql.insert(table)
+        same_domain = table.c.domain_name == statement.inserted.domain_name
+        statement = statement.on_duplicate_key_update(
+            {column: func.if_(same_domain, statement.inserted[column], table.c[column]) for column in update_columns}
+        )
+    elif dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.permutation_name],
+            set_={column: statement.excluded[column] for column in update_columns},
+            where=table.c.domain_name == statement.excluded.domain_name,
+        )
+    else:
+        # No native upsert: fall back to per-row merges
+        for row in rows:
+            existing = session.get(Permutation, row["permutation_name"])
+            if existing is None or existing.domain_name == row["domain_name"]:
+                session.merge(Permutation(**row))
+        return
+
+    # One compiled statement executed per batch; the driver sends each batch as
+    # multi-row VALUES (mysqlclient/mysql-connector rewrite executemany INSERTs)
+    for batch in chunked(rows, batch_size):
+        session.execute(statement, batch)
+
+
+def new_change_counts() -> dict:
+    return {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+
+
+def _history_row(scan_id: str, domain_name: str, change: str, values, scanned_at: datetime) -> dict:
+    row = {
+        "scan_id": scan_id,
+        "permutation_name": values["permutation_name"],
+        "domain_name": domain_name,
+        "change": change,
+        "scanned_at": scanned_at,
+    }
+    row.update({field: values[field] for field in HISTORY_FIELDS})
+    return row
+
+
+def apply_scan_chunk(session: Session, domain_name: str, scan_id: str, rows: list[dict], changes: dict) -> set:
+    """Diffs a chunk of scan rows against the stored permutations and writes only what's new or changed.
+
+    Each written row is also recorded in ScanHistory under the scan id.
+    `changes` is updated with added/changed/unchanged counts. Returns the names
+    already stored under another domain: the key is global, so those stay with
+    the domain that has them and aren't written or counted for this one.
+    """
+    if not rows:
+        return set()
+
+    names = [row["permutation_name"] for row in rows]
+    stored = {
+        row.permutation_name: row
+        for row in session.execute(
+            select(Permutation.permutation_name, *(getattr(Permutation, field) for field in DIFF_FIELDS))
+            .where((Permutation.domain_name == domain_name) & Permutation.permutation_name.in_(names))
+        )
+    }
+    owned_elsewhere = set()
+    if len(stored) < len(names):
+        owned_elsewhere = set(session.execute(
+            select(Permutation.permutation_name)
+            .where((Permutation.domain_name != domain_name) & Permutation.permutation_name.in_(names))
+        ).scalars())
+
+    scanned_at = datetime.now()
+    writes = []
+    history = []
+    for row in rows:
+        if row["permutation_name"] in owned_elsewhere:
+            continue
+        previous = stored.get(row["permutation_name"])
+        if previous is None:
+            change = "added"
+        elif any(getattr(previous, field) != row[field] for field in DIFF_FIELDS):
+            change = "changed"
+        else:
+            changes["unchanged"] += 1
+            continue
+
+        changes[change] += 1
+        writes.append(dict(row, scan_id=scan_id))
+        history.append(_history_row(scan_id, domain_name, change, row, scanned_at))
+
+    upsert_permutations(session, writes)
+    if history:
+        session.execute(insert(ScanHistory), history)
+    return owned_elsewhere
+
+
+def remove_vanished_permutations(session: Session, domain_name: str, scan_id: str, seen_names: set,
+                                 changes: dict, batch_size: int = UPSERT_BATCH_SIZE) -> None:
+    """Deletes the domain's stored permutations that this scan didn't report and records them as removed."""
+    vanished = [
+        row._asdict()
+        for row in session.execute(
+            select(Permutation.permutation_name, *(getattr(Permutation, field) for field in HISTORY_FIELDS))
+            .where(Permutation.domain_name == domain_name)
+            .execution_options(yield_per=1000)
+        )
+        if row.permutation_name not in seen_names
+    ]
+    if not vanished:
+        return
+
+    scanned_at = datetime.now()
+    for batch in chunked(vanished, batch_size):
+        session.execute(
+            delete(Permutation).where(
+                (Permutation.domain_name == domain_name) &
+                Permutation.permutation_name.in_([row["permutation_name"] for row in batch])
+            )
+        )
+        session.execute(insert(ScanHistory), [
+            _history_row(scan_id, domain_name, "removed", row, scanned_at) for row in batch
+        ])
+    changes["removed"] += len(vanished)
+
+
+def prune_scan_history(session: Session, domain_name: str,
+                       retention_days: int = SCAN_HISTORY_RETENTION_DAYS) -> int:
+    """Deletes the domain's history older than the retention period; returns the rows deleted."""
+    if retention_days <= 0:
+        return 0
+    result = session.execute(
+        delete(ScanHistory).where(
+            (ScanHistory.domain_name == domain_name) &
+            (ScanHistory.scanned_at < datetime.now() - timedelta(days=retention_days))
+        )
+    )
+    return result.rowcount
+
+
+def delete_scan_history(session: Session, domain_name: str) -> None:
+    """Deletes all of a domain's history, for when the domain itself is deleted."""
+    session.execute(delete(ScanHistory).where(ScanHistory.domain_name == domain_name))
+
+
+def ingest_scan(session: Session, user_id: str, domain_name: str, scan_id: str,
+                chunks: Iterable[list[dict]]) -> dict:
+    """Writes a scan's dnstwist results chunk by chunk, removes what it no longer reports and updates the counters.
+
+    The caller owns the transaction; nothing is committed here. Returns the
+    scan's total/processed/skipped counts, risk levels and changes.
+    """
+    total_count = 0
+    processed_count = 0
+    skipped_count = 0
+    risk_levels = dict.fromkeys(RISK_LEVELS, 0)
+    changes = new_change_counts()
+    seen_names = set()
+    ingest_seconds = 0.0
+
+    # Diff each chunk against the stored state and write only what changed
+    for chunk in chunks:
+        started = time.perf_counter()
+        rows = []
+        for permutation in chunk:
+            total_count += 1
+            row = build_permutation_row(permutation, domain_name)
+            if row is None:
+                skipped_count += 1
+                continue
+            rows.append(row)
+
+        with tracer.start_as_current_span("db.flush", attributes={"rows": len(rows)}):
+            owned_elsewhere = apply_scan_chunk(session, domain_name, scan_id, rows, changes)
+        if owned_elsewhere:
+            logger.info(f"Scan of {domain_name} skipped {len(owned_elsewhere)} permutations stored under another domain")
+
+        for row in rows:
+            if row["permutation_name"] in owned_elsewhere:
+                skipped_count += 1
+                continue
+            risk_levels[row["risk_level"]] += 1
+            seen_names.add(row["permutation_name"])
+            processed_count += 1
+        ingest_seconds += time.perf_counter() - started
+
+    # Anything this scan didn't report is gone
+    started = time.perf_counter()
+    with tracer.start_as_current_span("db.remove_vanished"):
+        remove_vanished_permutations(session, domain_name, scan_id, seen_names, changes)
+
+    # Every scan adds to the history, so each one also drops what has aged out
+    with tracer.start_as_current_span("db.prune_history"):
+        prune_scan_history(session, domain_name)
+
+    # Store the domain's counts and move the user's totals by the difference, as in-database increments
+    with tracer.start_as_current_span("db.record_counts"):
+        record_domain_scan(session, user_id, domain_name, risk_levels, len(seen_names), datetime.now())
+    SCAN_INGEST_SECONDS.observe(ingest_seconds + time.perf_counter() - started)
+
+    return {
+        "total_permutations": total_count,
+        "processed_count": processed_count,
+        "skipped_count": skipped_count,
+        "changes": changes,
+        "risk_levels": risk_levels,
+    }
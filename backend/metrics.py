@@ -0,0 +1,383 @@
+"""Prometheus-style metrics for the scan pipeline and the API.
+
+A small in-process registry (no client library needed) of counters, gauges
+and histograms, rendered by GET /metrics in the Prometheus text exposition
+format. Values are per process. Under a multi-process server set METRICS_DIR
+(gunicorn.conf.py does): every process then writes its values to a file there
+every METRICS_WRITE_SECONDS, and /metrics adds up the files of all processes,
+so whichever worker answers the scrape reports the whole server. Counters and
+histograms of exited processes keep counting; their gauges are dropped.
+Gauges read from a callback are reported by the answering process alone.
+"""
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+METRICS_DIR = os.getenv("METRICS_DIR")  # One directory per server, shared by its worker processes
+METRICS_WRITE_SECONDS = float(os.getenv("METRICS_WRITE_SECONDS", "5"))  # How stale other workers' values may be
+
+# Seconds; spans quick API calls up to dnstwist runs of several minutes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(labels: Iterable[tuple]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in labels]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    """Holds metrics in registration order and renders them, merged across processes when `directory` is set."""
+
+    def __init__(self, directory: Optional[str] = None, write_seconds: float = METRICS_WRITE_SECONDS):
+        self.directory = directory
+        self.write_seconds = write_seconds
+        self._metrics = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def start_sharing(self):
+        """Starts writing this process's values to `directory`; does nothing without one."""
+        if not self.directory or self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True)
+        self._thread.start()
+
+    def stop_sharing(self):
+        """Stops the writer after one last write, so nothing this process counted is lost."""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join()
+        self.write()
+
+    def write(self):
+        """Writes this process's values to <directory>/<pid>.json, replacing the previous file atomically."""
+        with self._lock:
+            metrics = list(self._metrics)
+        snapshot = {
+            metric.name: {"type": metric.type, "values": metric.export()} for metric in metrics if metric.shared
+        }
+        _write_json(os.path.join(self.directory, f"{os.getpid()}.json"), snapshot)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.write_seconds):
+            try:
+                self.write()
+            except OSError:
+                pass  # Retried on the next tick; a scrape only sees slightly older values meanwhile
+
+    def _read_shared(self) -> dict[str, list]:
+        """Every process's exported values, by metric name."""
+        exports: dict[str, list] = {}
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue  # Removed or replaced while we listed the directory
+            for name, entry in snapshot.items():
+                exports.setdefault(name, []).append(entry["values"])
+        return exports
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+        exports = None
+        if self._thread is not None:
+            self.write()  # Our own values as of now, not as of the last tick
+            exports = self._read_shared()
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            if exports is not None and metric.shared:
+                lines.extend(metric.samples(metric.merge(exports.get(metric.name, []))))
+            else:
+                lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+def _write_json(path: str, data) -> None:
+    directory = os.path.dirname(path)
+    fd, temporary = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def mark_process_dead(pid: int, directory: Optional[str] = METRICS_DIR) -> None:
+    """Drops the gauges of an exited process from the shared values, keeping its counters and histograms.
+
+    Meant for the server's master process (gunicorn's child_exit hook).
+    """
+    if not directory:
+        return
+    path = os.path.join(directory, f"{pid}.json")
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return
+    _write_json(path, {name: entry for name, entry in snapshot.items() if entry["type"] != "gauge"})
+
+
+def clear_shared(directory: Optional[str] = METRICS_DIR) -> None:
+    """Removes the values left by a previous run of the server."""
+    if not directory or not os.path.isdir(directory):
+        return
+    for filename in os.listdir(directory):
+        if filename.endswith(".json"):
+            os.unlink(os.path.join(directory, filename))
+
+
+REGISTRY = Registry(METRICS_DIR)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # Unlabelled series are reported from the start, at zero
+            self._values[()] = self._zero()
+        registry.register(self)
+
+    def _zero(self):
+        return 0
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_pairs(self, key: tuple) -> list[tuple]:
+        return list(zip(self.labelnames, key))
+
+    @property
+    def shared(self) -> bool:
+        """Whether the values are merged across processes under METRICS_DIR."""
+        return True
+
+    def _copy(self) -> dict:
+        with self._lock:
+            return dict(self._values)
+
+    def export(self) -> list:
+        """The values in a JSON-serializable form, for merging across processes."""
+        return [[list(key), value] for key, value in self._copy().items()]
+
+    def merge(self, exports: list) -> dict:
+        """Adds up values exported by several processes."""
+        merged: dict[tuple, float] = {}
+        for export in exports:
+            for key, value in export:
+                key = tuple(key)
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def samples(self, values: Optional[dict] = None) -> list[str]:
+        items = sorted((self._copy() if values is None else values).items())
+        return [f"{self.name}{_labels_text(self._label_pairs(key))} {_format_value(value)}" for key, value in items]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, either set directly or read from a callback on every scrape."""
+
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def set_function(self, function: Callable[[], float]):
+        """Reports function() at scrape time; only for unlabelled gauges."""
+        self._function = function
+
+    @property
+    def shared(self) -> bool:
+        return self._function is None
+
+    def samples(self, values: Optional[dict] = None) -> list[str]:
+        if self._function is not None:
+            try:
+                return [f"{self.name} {_format_value(self._function())}"]
+            except Exception:
+                # A failing callback (e.g. the database is down) drops the sample rather than the scrape
+                return []
+        return super().samples(values)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple = DEFAULT_BUCKETS, **kwargs):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(*args, **kwargs)
+
+    def _zero(self):
+        return [0] * len(self.buckets), 0.0
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or self._zero()
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _copy(self) -> dict:
+        with self._lock:
+            return {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+
+    def merge(self, exports: list) -> dict:
+        merged: dict[tuple, tuple] = {}
+        for export in exports:
+            for key, (counts, total) in export:
+                key = tuple(key)
+                merged_counts, merged_total = merged.get(key) or self._zero()
+                merged[key] = ([a + b for a, b in zip(merged_counts, counts)], merged_total + total)
+        return merged
+
+    def samples(self, values: Optional[dict] = None) -> list[str]:
+        items = sorted((self._copy() if values is None else values).items())
+        lines = []
+        for key, (counts, total) in items:
+            pairs = self._label_pairs(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels_text(pairs + [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(pairs)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_labels_text(pairs)} {cumulative}")
+        return lines
+
+
+def timed_iter(iterable: Iterable, histogram: Histogram, **labels) -> Iterator:
+    """Yields from `iterable` and observes the total time spent producing its items once it's exhausted.
+
+    Only time inside the iterable counts, not time the consumer spends
+    between items, so a streamed scan can be timed apart from its ingestion.
+    """
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - started
+            yield item
+    finally:
+        histogram.observe(elapsed, **labels)
+
+
+# ------------------------- Scan pipeline -------------------------
+
+SCAN_DNSTWIST_SECONDS = Histogram(
+    "fuzzify_scan_dnstwist_seconds", "Time spent producing dnstwist results for one scan.", ("engine",))
+SCAN_JSON_PARSE_SECONDS = Histogram(
+    "fuzzify_scan_json_parse_seconds", "Time spent parsing dnstwist JSON output for one scan (subprocess engine).")
+SCAN_INGEST_SECONDS = Histogram(
+    "fuzzify_scan_ingest_seconds", "Time spent diffing and writing one scan's permutations before commit.")
+SCAN_COMMIT_SECONDS = Histogram(
+    "fuzzify_scan_commit_seconds", "Time spent committing one scan's transaction.")
+PERMUTATIONS_PROCESSED = Counter(
+    "fuzzify_permutations_processed_total", "dnstwist results stored as permutations.")
+PERMUTATIONS_SKIPPED = Counter(
+    "fuzzify_permutations_skipped_total", "dnstwist results skipped for missing hashes or DNS records.")
+SCAN_FAILURES = Counter(
+    "fuzzify_scan_failures_total", "Scans that failed, by failure type.", ("type",))
+SCANS_IN_FLIGHT = Gauge(
+    "fuzzify_scans_in_flight", "Scans currently running in this process.")
+SCAN_QUEUE_DEPTH = Gauge(
+    "fuzzify_scan_queue_depth", "Scan jobs waiting for a worker.")
+PUBSUB_MESSAGES_RECEIVED = Counter(
+    "fuzzify_pubsub_messages_received_total", "Pub/Sub messages received, by message type.", ("type",))
+
+# ------------------------- API -------------------------
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "fuzzify_http_request_seconds", "Request handling time per endpoint, up to the first byte of the response.",
+    ("method", "endpoint", "status"))
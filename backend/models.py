@@ -2,7 +2,7 @@ from sqlmodel import SQLModel, Field
 from typing import Optional
 from datetime import datetime
 from uuid import uuid4
-from sqlalchemy import DateTime
+from sqlalchemy import Column, Text, Index
 
 # User Table 
 class User(SQLModel, table=True):
@@ -16,6 +16,8 @@ class User(SQLModel, table=True):
     medium_risk_domains: int = Field(default=0)
     low_risk_domains: int = Field(default=0)
     unknown_domains: int = Field(default=0)
+    permutation_count: int = Field(default=0)  # Stored permutations across the user's domains
+    scan_generation: int = Field(default=0)  # Bumped whenever the user's domains or scan results change
 
 #  Domain Table
 class Domain(SQLModel, table=True):
@@ -31,9 +33,14 @@ class Domain(SQLModel, table=True):
     medium_risk_domains: int = Field(default=0)
     low_risk_domains: int = Field(default=0)
     unknown_domains: int = Field(default=0)
+    permutation_count: int = Field(default=0)  # Stored permutations of this domain
 
 class Permutation(SQLModel, table=True):
-    __table_args__ = {"extend_existing": True}
+    __table_args__ = (
+        # Keyset pagination of a domain's permutations ordered by risk
+        Index("ix_permutation_domain_risk", "domain_name", "risk", "permutation_name"),
+        {"extend_existing": True},
+    )
     permutation_name: str = Field(primary_key=True)  # Name of generated domain variation
     domain_name: str = Field(foreign_key="domain.domain_name")  # Links to real domain
     fuzzer: str = Field(default="")
@@ -45,6 +52,7 @@ class Permutation(SQLModel, table=True):
     phash: Optional[int] = Field(default=None)
     risk: Optional[float] = Field(default=-1.0)  # Add risk attribute
     risk_level: Optional[str] = Field(default="Unknown")  # Add risk level attribute
+    scan_id: Optional[str] = Field(default=None)  # Scan that last wrote this permutation
 
 class Schedule(SQLModel, table=True):
     schedule_id: str = Field(default_factory=lambda: str(uuid4()), primary_key=True)
@@ -52,4 +60,44 @@ class Schedule(SQLModel, table=True):
     schedule_name: str = Field(default=None)  # Name of the schedule
     domain_name: str = Field(foreign_key="domain.domain_name")  # Links to Domain
     start_date: datetime = Field(default_factory=datetime.now)  # Start date of the schedule
-    next_scan: datetime = Field(default=None)  # Next scheduled scan time
\ No newline at end of file
+    next_scan: datetime = Field(default=None, index=True)  # Next scheduled scan time
+    interval_hours: Optional[int] = Field(default=None)  # Hours between scans
+    lease_owner: Optional[str] = Field(default=None)  # Scheduler process currently running this schedule
+    lease_expires_at: Optional[datetime] = Field(default=None)  # When another scheduler may claim it
+
+class ScanHistory(SQLModel, table=True):
+    __table_args__ = {"extend_existing": True}
+    scan_id: str = Field(primary_key=True)  # Scan that produced this delta
+    permutation_name: str = Field(primary_key=True)  # Permutation that changed
+    domain_name: str = Field(index=True)  # Real domain that was scanned
+    change: str = Field(default="")  # "added", "changed" or "removed"
+    ip_address: Optional[str] = Field(default=None)  # Values after the change (before it for "removed")
+    mail_server: Optional[str] = Field(default=None)
+    server: Optional[str] = Field(default=None)
+    tlsh: Optional[int] = Field(default=None)
+    phash: Optional[int] = Field(default=None)
+    risk: Optional[float] = Field(default=None)
+    risk_level: Optional[str] = Field(default=None)
+    scanned_at: datetime = Field(default_factory=datetime.now)  # When the delta was recorded
+
+class ScanJobRecord(SQLModel, table=True):
+    __table_args__ = {"extend_existing": True}
+    job_id: str = Field(primary_key=True)  # Id handed back by POST .../permutations
+    user_id: str = Field(index=True)  # User who requested the scan
+    domain_name: str = Field(index=True)  # Domain being scanned
+    options_key: str = Field(default="")  # Scan engine options, for coalescing
+    active_key: Optional[str] = Field(default=None, unique=True, index=True)  # domain|options while queued or running; one active job per key
+    status: str = Field(default="queued")  # queued, running, done or failed
+    attempts: int = Field(default=0)  # Deliveries that started running the scan
+    created_at: datetime = Field(default_factory=datetime.now)
+    started_at: Optional[datetime] = Field(default=None)
+    finished_at: Optional[datetime] = Field(default=None)
+    result: Optional[str] = Field(default=None, sa_column=Column(Text))  # JSON scan summary
+    error: Optional[str] = Field(default=None)
+    details: Optional[str] = Field(default=None, sa_column=Column(Text))
+
+class ServiceLease(SQLModel, table=True):
+    __table_args__ = {"extend_existing": True}
+    name: str = Field(primary_key=True)  # Role being leased, e.g. "background"
+    owner: Optional[str] = Field(default=None)  # Process currently holding the role
+    expires_at: Optional[datetime] = Field(default=None)  # When another process may take it over
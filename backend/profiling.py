@@ -0,0 +1,158 @@
+"""Opt-in profiling of single API requests.
+
+Off unless PROFILING_ENABLED=true, in which case install_profiler() adds the
+hooks; otherwise nothing is registered and requests pay nothing. With it on,
+a request sent with `X-Profile: 1` (or `?profile=1`) runs under cProfile.
+When PROFILING_TOKEN is set the header must carry it instead of 1.
+
+The profiled response carries X-Profile-Id and a Server-Timing header with
+total and SQL time. The full profile is stored in PROFILE_DIR as <id>.prof
+(pstats, for snakeviz and friends) and <id>.json, and is served by
+GET /api/profiles/<id>: top functions and SQL statement count and time.
+Scans run on the scan workers, not in the request that queued them, so their
+dnstwist time shows up in /metrics and the traces rather than in a profile.
+"""
+import cProfile
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from uuid import uuid4
+
+from flask import abort, g, jsonify, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN")  # Required value of X-Profile when set
+PROFILE_DIR = os.getenv("PROFILE_DIR", "logs/profiles")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))  # Functions listed in a profile summary
+
+# Only one cProfile may run per process, so concurrent profile requests are served unprofiled
+_profile_lock = threading.Lock()
+# SQL statements of the request being profiled on this thread
+_sql = threading.local()
+
+
+def _wants_profile() -> bool:
+    flag = request.headers.get("X-Profile") or request.args.get("profile")
+    if not flag:
+        return False
+    if PROFILING_TOKEN:
+        return flag == PROFILING_TOKEN
+    return flag.lower() in ("1", "true")
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_sql, "stats", None) is not None:
+        conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = getattr(_sql, "stats", None)
+    starts = conn.info.get("profile_query_start")
+    if stats is not None and starts:
+        stats["statements"] += 1
+        stats["seconds"] += time.perf_counter() - starts.pop()
+
+
+def _function_name(key: tuple) -> str:
+    filename, line, name = key
+    return f"{filename}:{line}({name})" if line else name
+
+
+def summarize(profile: cProfile.Profile, sql: dict, total_seconds: float, top_n: int = PROFILE_TOP_N) -> dict:
+    """Top functions by cumulative time, plus SQL time, from a finished profile."""
+    stats = pstats.Stats(profile).stats
+    by_cumulative = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    return {
+        "total_seconds": round(total_seconds, 6),
+        "sql_statements": sql["statements"],
+        "sql_seconds": round(sql["seconds"], 6),
+        "top_functions": [
+            {
+                "function": _function_name(key),
+                "calls": calls,
+                "own_seconds": round(own, 6),
+                "cumulative_seconds": round(cumulative, 6),
+            }
+            for key, (_, calls, own, cumulative, _) in by_cumulative[:top_n]
+        ],
+    }
+
+
+def _start_profile():
+    if not _wants_profile() or not _profile_lock.acquire(blocking=False):
+        return
+    g.profile = cProfile.Profile()
+    g.profile_started = time.perf_counter()
+    _sql.stats = {"statements": 0, "seconds": 0.0}
+    g.profile.enable()
+
+
+def _finish_profile(response):
+    profile = g.pop("profile", None)
+    if profile is None:
+        return response
+    try:
+        profile.disable()
+        total_seconds = time.perf_counter() - g.pop("profile_started")
+        summary = summarize(profile, _sql.stats, total_seconds)
+    finally:
+        _sql.stats = None
+        _profile_lock.release()
+
+    profile_id = str(uuid4())
+    summary.update(profile_id=profile_id, method=request.method, path=request.full_path,
+                   status=response.status_code)
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile.dump_stats(os.path.join(PROFILE_DIR, f"{profile_id}.prof"))
+        with open(os.path.join(PROFILE_DIR, f"{profile_id}.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+    except OSError as e:
+        logger.error(f"Failed to store profile {profile_id}: {e}")
+
+    response.headers["X-Profile-Id"] = profile_id
+    response.headers["Server-Timing"] = (
+        f"total;dur={summary['total_seconds'] * 1000:.1f}, "
+        f"sql;dur={summary['sql_seconds'] * 1000:.1f};desc=\"{summary['sql_statements']} statements\""
+    )
+    logger.info(f"Profiled {request.method} {request.path} as {profile_id}: {summary['total_seconds']:.3f}s, "
+                f"{summary['sql_statements']} SQL statements in {summary['sql_seconds']:.3f}s")
+    return response
+
+
+def _abandon_profile(error):
+    # after_request doesn't run when the view raised; don't leave the profiler on
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.disable()
+        _sql.stats = None
+        _profile_lock.release()
+
+
+def get_profile(profile_id: str):
+    """API endpoint to fetch a stored profile summary."""
+    try:
+        with open(os.path.join(PROFILE_DIR, f"{os.path.basename(profile_id)}.json")) as f:
+            return jsonify(json.load(f)), 200
+    except FileNotFoundError:
+        abort(404)
+
+
+def install_profiler(app, enabled: bool = PROFILING_ENABLED) -> None:
+    """Adds the per-request profiling hooks and GET /api/profiles/<id> when profiling is enabled."""
+    if not enabled:
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    app.before_request(_start_profile)
+    app.after_request(_finish_profile)
+    app.teardown_request(_abandon_profile)
+    app.add_url_rule("/api/profiles/<profile_id>", "get_profile", get_profile, methods=["GET"])
+    logger.warning("Request profiling is enabled (X-Profile header)")
@@ -0,0 +1,96 @@
+import base64
+import json
+from typing import Iterator, Optional
+
+from sqlalchemy import and_, or_
+from sqlmodel import Session, select
+
+from models import Permutation
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Columns returned by the permutations listing, in response order
+PERMUTATION_FIELDS = ("permutation_name", "domain_name", "fuzzer", "server", "mail_server", "ip_address",
+                      "mx_spy", "tlsh", "phash", "risk", "risk_level")
+PERMUTATION_COLUMNS = tuple(getattr(Permutation, field) for field in PERMUTATION_FIELDS)
+
+
+def encode_cursor(risk, permutation_name: str) -> str:
+    """Opaque cursor pointing just past the last row of a page."""
+    raw = json.dumps([risk, permutation_name]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Inverse of encode_cursor. Raises ValueError for anything malformed."""
+    try:
+        risk, permutation_name = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(permutation_name, str) or not isinstance(risk, (int, float)):
+        raise ValueError("Invalid cursor")
+    return risk, permutation_name
+
+
+def permutation_filters(domain_name: str, risk_levels: Optional[list[str]] = None,
+                        fuzzer: Optional[str] = None, min_risk: Optional[float] = None) -> list:
+    """WHERE clauses shared by the listing and anything else that filters a domain's permutations."""
+    clauses = [Permutation.domain_name == domain_name]
+    if risk_levels:
+        clauses.append(Permutation.risk_level.in_(risk_levels))
+    if fuzzer:
+        clauses.append(Permutation.fuzzer == fuzzer)
+    if min_risk is not None:
+        clauses.append(Permutation.risk >= min_risk)
+    return clauses
+
+
+def permutation_rows(session: Session, filters: list) -> list[dict]:
+    """Every matching permutation as a plain dict, selecting only the listed columns (no ORM objects)."""
+    return [dict(zip(PERMUTATION_FIELDS, row))
+            for row in session.exec(select(*PERMUTATION_COLUMNS).where(*filters))]
+
+
+def iter_permutation_rows(session: Session, filters: list, batch_size: int = 1000) -> Iterator[dict]:
+    """Like permutation_rows(), but fetched from a server-side cursor `batch_size` rows at a time."""
+    query = select(*PERMUTATION_COLUMNS).where(*filters).execution_options(yield_per=batch_size)
+    for row in session.exec(query):
+        yield dict(zip(PERMUTATION_FIELDS, row))
+
+
+def permutation_page(session: Session, filters: list, limit: int = DEFAULT_PAGE_SIZE,
+                     cursor: Optional[str] = None, descending: bool = True) -> tuple[list[dict], Optional[str]]:
+    """One page of permutations ordered by (risk, permutation_name), and the cursor for the next page.
+
+    Uses keyset pagination over ix_permutation_domain_risk: the cursor turns
+    into a range condition, so every page costs the same as the first. The
+    range comparisons skip NULL risks, so ingest never stores one (see
+    ingest.MISSING_RISK).
+    """
+    query = select(*PERMUTATION_COLUMNS).where(*filters)
+
+    if cursor:
+        risk, permutation_name = decode_cursor(cursor)
+        if descending:
+            query = query.where(or_(
+                Permutation.risk < risk,
+                and_(Permutation.risk == risk, Permutation.permutation_name < permutation_name),
+            ))
+        else:
+            query = query.where(or_(
+                Permutation.risk > risk,
+                and_(Permutation.risk == risk, Permutation.permutation_name > permutation_name),
+            ))
+
+    if descending:
+        query = query.order_by(Permutation.risk.desc(), Permutation.permutation_name.desc())
+    else:
+        query = query.order_by(Permutation.risk.asc(), Permutation.permutation_name.asc())
+
+    # Fetch one extra row to learn whether another page exists
+    rows = [dict(zip(PERMUTATION_FIELDS, row)) for row in session.exec(query.limit(limit + 1))]
+    if len(rows) <= limit:
+        return rows, None
+    page = rows[:limit]
+    return page, encode_cursor(page[-1]["risk"], page[-1]["permutation_name"])
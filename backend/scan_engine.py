@@ -0,0 +1,437 @@
+import json
+import logging
+import os
+import queue
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from io import BytesIO
+from typing import Iterator, Optional, TextIO
+
+from metrics import SCAN_JSON_PARSE_SECONDS
+from tracing import tracer, record_aggregate_span
+
+logger = logging.getLogger(__name__)
+
+SCAN_ENGINE = os.getenv("SCAN_ENGINE", "library")  # "library" (in-process), "subprocess" or "fake" (offline)
+DNSTWIST_THREADS = max(1, (os.cpu_count() or 2) - 1)
+DNSTWIST_DICTIONARY = os.getenv("DNSTWIST_DICTIONARY")  # Optional subdomain dictionary file
+DNSTWIST_TLD = os.getenv("DNSTWIST_TLD")  # Optional TLD dictionary file
+READ_SIZE = 64 * 1024  # Bytes of dnstwist output parsed at a time
+JSON_WHITESPACE = " \t\r\n"
+JSON_NUMBER_CHARS = frozenset("+-.0123456789eE")
+
+# SCAN_ENGINE=fake: simulated dnstwist for offline load tests
+FAKE_SCAN_RESULTS = int(os.getenv("FAKE_SCAN_RESULTS", "1000"))  # Results per scan
+FAKE_SCAN_LATENCY_SECONDS = float(os.getenv("FAKE_SCAN_LATENCY_SECONDS", "5"))  # Median scan duration
+FAKE_SCAN_LATENCY_SIGMA = float(os.getenv("FAKE_SCAN_LATENCY_SIGMA", "0.5"))  # Log-normal spread, 0 for fixed
+FAKE_SCAN_FAILURE_RATE = float(os.getenv("FAKE_SCAN_FAILURE_RATE", "0"))  # Share of scans that fail
+FAKE_SCAN_SEED = int(os.getenv("FAKE_SCAN_SEED", "0"))
+
+SIMULATED_FUZZERS = ("addition", "bitsquatting", "homoglyph", "hyphenation", "insertion", "omission", "repetition",
+                     "replacement", "subdomain", "transposition", "vowel-swap", "dictionary", "tld-swap")
+SIMULATED_BANNERS = ("nginx", "Apache", "cloudflare", "Microsoft-IIS/10.0", "LiteSpeed", None)
+
+
+class ScanEngineError(Exception):
+    """Raised when dnstwist fails to produce results for a domain."""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details
+
+
+class TimedJSONDecoder(json.JSONDecoder):
+    """JSONDecoder that adds up the time spent decoding, for the parse-time metric."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.seconds = 0.0
+
+    def raw_decode(self, s, idx=0):
+        started = time.perf_counter()
+        try:
+            return super().raw_decode(s, idx)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+def iter_json_array(stream: TextIO, read_size: int = READ_SIZE,
+                    decoder: Optional[json.JSONDecoder] = None) -> Iterator:
+    """Yields the elements of a top-level JSON array as they are read from a text stream.
+
+    Only one element (plus one read block) is held in memory at a time. Empty
+    input yields nothing, which is what dnstwist prints when nothing is found.
+    Elements must be separated by exactly one comma; anything else raises
+    ValueError (json.JSONDecodeError for a malformed element).
+    """
+    decoder = decoder or json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    expecting = "["  # "[", "first" (element or "]"), "element" (after a comma) or "separator"
+    read_more = True
+
+    while True:
+        if read_more:
+            chunk = stream.read(read_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            read_more = False
+
+        while pos < len(buffer) and buffer[pos] in JSON_WHITESPACE:
+            pos += 1
+        if pos == len(buffer):
+            if not eof:
+                read_more = True
+                continue
+            if expecting != "[":
+                raise ValueError("Unterminated JSON array")
+            return
+
+        char = buffer[pos]
+        if expecting == "[":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            expecting = "first"
+            continue
+        if expecting == "separator":
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' between array elements, got {char!r}")
+            pos += 1
+            expecting = "element"
+            continue
+        if char == "]" and expecting == "first":
+            return
+        if char in ",]":
+            raise ValueError(f"Expected an array element, got {char!r}")
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more = True  # The element continues in the next block
+            continue
+        # A number (or literal) touching the end of what was read may be cut short, e.g. "1" of "1.5"
+        if not eof and not isinstance(item, (dict, list, str)) and (
+            end == len(buffer) or buffer[end] in JSON_NUMBER_CHARS
+        ):
+            read_more = True
+            continue
+        pos = end
+        expecting = "separator"
+        yield item
+
+
+def simulated_results(domain_name: str, count: int, seed: int = 0, changed_every: int = 0) -> Iterator[dict]:
+    """Yields `count` dnstwist-shaped results for a domain without any DNS or HTTP lookups.
+
+    The output only depends on the arguments. Every n-th result (n =
+    `changed_every`) gets a different address and scores than with 0, which
+    is what a rescan that found changes looks like. About 3% resolve to
+    !ServFail and 3% lack a tlsh or phash, as in real scans.
+    """
+    name, _, tld = domain_name.rpartition(".")
+    name, tld = (name, tld) if name else (tld, "com")
+    rng = random.Random(f"{seed}:{domain_name}")
+    for i in range(count):
+        fuzzer = SIMULATED_FUZZERS[i % len(SIMULATED_FUZZERS)]
+        ip = [10, rng.randrange(256), rng.randrange(256), rng.randrange(1, 255)]
+        tlsh = rng.randrange(1, 101)
+        phash = rng.randrange(0, 101)
+        roll = rng.random()
+        if changed_every and i % changed_every == 0:
+            ip[0] = 172
+            tlsh = tlsh % 100 + 1
+
+        result = {
+            "fuzzer": fuzzer,
+            "domain": f"{name}-{fuzzer}-{i}.{tld}",
+            "dns_a": [".".join(map(str, ip))],
+            "dns_mx": [f"mx{i % 3}.{name}-{i}.{tld}"] if roll < 0.6 else [],
+            "banner_http": SIMULATED_BANNERS[i % len(SIMULATED_BANNERS)],
+            "tlsh": tlsh,
+            "phash": phash,
+        }
+        if roll > 0.97:
+            result["dns_a"] = ["!ServFail"]
+        elif roll > 0.955:
+            del result["phash"]
+        elif roll > 0.94:
+            del result["tlsh"]
+        yield result
+
+
+class ScanEngine(ABC):
+    """Runs a dnstwist scan for a domain and yields the registered permutations as dicts."""
+
+    name = "base"
+
+    def __init__(self, threads: int = DNSTWIST_THREADS, dictionary: Optional[str] = DNSTWIST_DICTIONARY,
+                 tld: Optional[str] = DNSTWIST_TLD):
+        self.threads = threads
+        self.dictionary = dictionary
+        self.tld = tld
+
+    @abstractmethod
+    def scan(self, domain_name: str) -> Iterator[dict]:
+        """Yields the registered permutations of `domain_name`; raises ScanEngineError when the scan fails."""
+
+    def options_key(self) -> str:
+        """Identifies the scan options, so scans are only coalesced when they'd produce the same results."""
+        return f"{self.name}|dictionary={self.dictionary}|tld={self.tld}"
+
+
+def first_records(permutation: dict) -> dict:
+    """Keeps only the first DNS record of each kind, as dnstwist does without --all."""
+    for key in ("dns_ns", "dns_a", "dns_aaaa", "dns_mx"):
+        if key in permutation:
+            permutation[key] = permutation[key][:1]
+    return permutation
+
+
+class PermutationQueue(queue.Queue):
+    """dnstwist's job queue that also passes on every permutation its Scanner threads finish.
+
+    Scanner takes a permutation with get(), fills in its lookups and calls
+    task_done(), so the permutation a thread got last is the one it just did.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.finished = queue.SimpleQueue()
+        self._current = threading.local()
+
+    def get(self, block=True, timeout=None):
+        self._current.task = super().get(block, timeout)
+        return self._current.task
+
+    def task_done(self):
+        # Passed on before it counts as done, so no unfinished tasks means everything was passed on
+        self.finished.put(self._current.task)
+        super().task_done()
+
+    def iter_finished(self, workers: list, poll_seconds: float = 0.5) -> Iterator:
+        """Yields finished permutations until all are done or every worker thread has exited."""
+        while self.unfinished_tasks or not self.finished.empty():
+            try:
+                task = self.finished.get(timeout=poll_seconds)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break  # Threads that crash drop their permutation, as they do in dnstwist.run()
+                continue
+            yield task
+        # A thread may have finished one more right before exiting
+        while not self.finished.empty():
+            yield self.finished.get()
+
+
+class LibraryScanEngine(ScanEngine):
+    """Calls dnstwist in-process so imports and hashing libraries stay warm between scans.
+
+    dnstwist.run() drives its argument parser through sys.argv, so concurrent
+    calls would trample each other's options. Instead this does what run()
+    does with dnstwist's own building blocks (Fuzzer, Scanner, the reference
+    page hashes), which keep all their state per scan, so scans run in
+    parallel. Dictionary and TLD files are read once, not on every scan.
+    Results are yielded as the lookup threads finish them rather than sorted
+    at the end, so a scan's results are never all held in memory at once.
+    """
+
+    name = "library"
+
+    # Same filters dnstwist.run() applies to the --dictionary and --tld files
+    DICTIONARY_PATTERN = r"^(?:(?:xn--)[a-z0-9-]{3,59}|[a-z0-9-]{1,63})$"
+    TLD_PATTERN = r"^[a-z0-9-]{2,63}(?:\.[a-z0-9-]{2,63})?$"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Importing here (once) pulls in tlsh, ppdeep, PIL and dnspython for every later scan
+        import dnstwist
+        self._dnstwist = dnstwist
+        self._dictionary = self._read_words(self.dictionary, self.DICTIONARY_PATTERN)
+        self._tld_dictionary = self._read_words(self.tld, self.TLD_PATTERN)
+
+    @staticmethod
+    def _read_words(path: Optional[str], pattern: str) -> list[str]:
+        if not path:
+            return []
+        with open(path, encoding="utf-8") as f:
+            return [word for word in set(f.read().lower().splitlines()) if re.match(pattern, word)]
+
+    def scan(self, domain_name: str) -> Iterator[dict]:
+        dnstwist = self._dnstwist
+        try:
+            with tracer.start_as_current_span("dnstwist.run", attributes={"threads": self.threads}):
+                url = dnstwist.UrlParser(domain_name)
+                fuzz = dnstwist.Fuzzer(url.domain, dictionary=self._dictionary, tld_dictionary=self._tld_dictionary)
+                fuzz.generate()
+                jobs = PermutationQueue()
+                for permutation in fuzz.domains:
+                    jobs.put(permutation)
+                workers = self._start_scanners(url, jobs)
+        except Exception as e:
+            raise ScanEngineError("dnstwist scan failed", str(e)) from e
+
+        # Hand on each registered permutation as soon as a lookup thread is done with it
+        try:
+            for permutation in jobs.iter_finished(workers):
+                if permutation.is_registered():
+                    yield first_records(permutation.copy())
+        finally:
+            # Also reached when the consumer stops early, so no lookup threads are left behind
+            for worker in workers:
+                worker.stop()
+            for worker in workers:
+                worker.join()
+
+    def _start_scanners(self, url, jobs: queue.Queue) -> list:
+        """Starts dnstwist's lookup threads with the options dnstwist.run() would set for our flags."""
+        dnstwist = self._dnstwist
+        if not dnstwist.MODULE_TLSH:
+            raise RuntimeError("missing py-tlsh library")
+        if not (dnstwist.MODULE_PIL and dnstwist.MODULE_SELENIUM):
+            raise RuntimeError("missing Python Imaging Library (PIL) or Selenium Webdriver")
+
+        # Reference hashes of the original site that every permutation is compared against
+        page = dnstwist.UrlOpener(url.full_uri(), timeout=dnstwist.REQUEST_TIMEOUT_HTTP,
+                                  headers={"User-Agent": dnstwist.USER_AGENT_STRING}, verify=True)
+        lsh_init = dnstwist.tlsh.hash(page.normalized_content)
+        browser = dnstwist.HeadlessBrowser(useragent=dnstwist.USER_AGENT_STRING)
+        try:
+            browser.get(url.full_uri())
+            phash_init = dnstwist.pHash(BytesIO(browser.screenshot()))
+        finally:
+            browser.stop()
+
+        workers = []
+        scan_id = int.from_bytes(os.urandom(4), sys.byteorder)
+        for _ in range(self.threads):
+            worker = dnstwist.Scanner(jobs)
+            worker.id = scan_id
+            worker.url = url
+            worker.option_extdns = dnstwist.MODULE_DNSPYTHON
+            # Both read the MX records only dnspython looks up; without it dnstwist's Scanner fails on them
+            worker.option_banners = dnstwist.MODULE_DNSPYTHON
+            worker.option_mxcheck = dnstwist.MODULE_DNSPYTHON
+            if lsh_init not in (None, "", "TNULL"):  # Too little content to compare against
+                worker.option_lsh = "tlsh"
+                worker.lsh_init = lsh_init
+                worker.lsh_effective_url = page.url.split("?")[0]
+            worker.option_phash = True
+            worker.phash_init = phash_init
+            worker.useragent = dnstwist.USER_AGENT_STRING
+            worker.start()
+            workers.append(worker)
+        return workers
+
+
+class SubprocessScanEngine(ScanEngine):
+    """Runs the dnstwist CLI in a child process and parses its JSON output as it streams in."""
+
+    name = "subprocess"
+
+    def command(self, domain_name: str) -> list[str]:
+        command = [
+            'dnstwist',
+            '--lsh', 'tlsh',
+            '--phash',
+            '--threads', str(self.threads),
+            '--mx',
+            '--banner',
+            '--registered',
+            '--format', 'json',
+        ]
+        if self.dictionary:
+            command += ['--dictionary', self.dictionary]
+        if self.tld:
+            command += ['--tld', self.tld]
+        command.append(f'{domain_name}')
+        return command
+
+    def scan(self, domain_name: str) -> Iterator[dict]:
+        # stderr goes to a file so a chatty dnstwist can't block on a full pipe
+        with tempfile.TemporaryFile(mode="w+") as stderr:
+            process = subprocess.Popen(self.command(domain_name), stdout=subprocess.PIPE, stderr=stderr, text=True)
+            decoder = TimedJSONDecoder()
+            try:
+                yield from iter_json_array(process.stdout, decoder=decoder)
+                returncode = process.wait()
+            finally:
+                SCAN_JSON_PARSE_SECONDS.observe(decoder.seconds)
+                record_aggregate_span("dnstwist.json_decode", decoder.seconds)
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+
+            if returncode != 0:
+                stderr.seek(0)
+                raise ScanEngineError("dnstwist command failed", stderr.read())
+
+
+class FakeScanEngine(ScanEngine):
+    """Simulates dnstwist offline: deterministic results per domain, log-normal latency and random failures."""
+
+    name = "fake"
+
+    def __init__(self, results: int = FAKE_SCAN_RESULTS, latency: float = FAKE_SCAN_LATENCY_SECONDS,
+                 latency_sigma: float = FAKE_SCAN_LATENCY_SIGMA, failure_rate: float = FAKE_SCAN_FAILURE_RATE,
+                 seed: int = FAKE_SCAN_SEED, **kwargs):
+        super().__init__(**kwargs)
+        self.results = results
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.seed = seed
+        # Latencies and failures follow one seeded sequence per process
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def scan(self, domain_name: str) -> Iterator[dict]:
+        with self._rng_lock:
+            latency = self.latency * self._rng.lognormvariate(0, self.latency_sigma) if self.latency_sigma else self.latency
+            fails = self._rng.random() < self.failure_rate
+
+        # Spread the latency over the stream the way a real scan trickles results in
+        slices = 10
+        batch = max(1, -(-self.results // slices))
+        results = simulated_results(domain_name, self.results, self.seed)
+        for index in range(slices):
+            time.sleep(latency / slices)
+            if fails and index == slices // 2:
+                raise ScanEngineError("dnstwist scan failed", "Simulated failure")
+            for _ in range(batch):
+                result = next(results, None)
+                if result is None:
+                    break
+                yield result
+
+    def options_key(self) -> str:
+        return f"{super().options_key()}|results={self.results}|seed={self.seed}"
+
+
+def create_scan_engine(name: str = SCAN_ENGINE) -> ScanEngine:
+    """Builds the configured scan engine, falling back to the CLI when dnstwist can't be imported."""
+    if name == LibraryScanEngine.name:
+        try:
+            return LibraryScanEngine()
+        except ImportError as e:
+            logger.warning(f"dnstwist library unavailable ({e}), falling back to subprocess engine")
+            return SubprocessScanEngine()
+    if name == SubprocessScanEngine.name:
+        return SubprocessScanEngine()
+    if name == FakeScanEngine.name:
+        logger.warning("Using the simulated dnstwist engine; scan results are fake")
+        return FakeScanEngine()
+    raise ValueError(f"Unknown scan engine: {name}")
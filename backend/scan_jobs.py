@@ -0,0 +1,179 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from uuid import uuid4
+
+from tracing import attached, current_context
+
+logger = logging.getLogger(__name__)
+
+# Job states reported by the job-status endpoint
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "2"))  # Scans allowed to run at once
+SCAN_QUEUE_LIMIT = int(os.getenv("SCAN_QUEUE_LIMIT", "100"))  # Scans allowed to wait for a worker
+SCAN_JOB_TTL = timedelta(minutes=int(os.getenv("SCAN_JOB_TTL_MINUTES", "60")))  # How long finished jobs are kept
+SCAN_FRESHNESS = timedelta(minutes=int(os.getenv("SCAN_FRESHNESS_MINUTES", "5")))  # Reuse scans finished this recently
+
+
+class QueueFullError(Exception):
+    """Raised when the scan queue has no room for another job."""
+
+
+class ScanDispatchError(QueueFullError):
+    """Raised when a scan job could not be handed to the workers (e.g. Pub/Sub is unreachable).
+
+    A QueueFullError, so callers that already answer 503 or retry later for a
+    full queue treat it the same way.
+    """
+
+
+class ScanFailedError(Exception):
+    """Raised by a scan function to fail a job with a client-facing error and details.
+
+    `retriable` marks failures worth running again (dnstwist or database
+    errors), as opposed to requests that can never succeed.
+    """
+
+    def __init__(self, error, details=None, retriable=False):
+        super().__init__(error)
+        self.error = error
+        self.details = details
+        self.retriable = retriable
+
+
+class ScanJob:
+    """A single permutation scan tracked from enqueue to completion."""
+
+    def __init__(self, user_id: str, domain_name: str, key: tuple):
+        self.job_id = str(uuid4())
+        self.user_id = user_id
+        self.domain_name = domain_name
+        self.key = key
+        self.status = QUEUED
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.details: Optional[str] = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "domain": self.domain_name,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "result": self.result,
+            "error": self.error,
+            "details": self.details,
+        }
+
+
+class ScanJobManager:
+    """Runs scan jobs on a bounded worker pool and keeps their status in memory.
+
+    Scans are coalesced per (domain, scan options): a request for a domain that
+    is already queued or running attaches to that job, and a scan that finished
+    within the freshness window is handed back instead of starting another.
+    """
+
+    def __init__(self, scan_func: Callable[[str, str], dict], max_workers: int = SCAN_WORKERS,
+                 queue_limit: int = SCAN_QUEUE_LIMIT, job_ttl: timedelta = SCAN_JOB_TTL,
+                 freshness: timedelta = SCAN_FRESHNESS):
+        self.scan_func = scan_func
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self.job_ttl = job_ttl
+        self.freshness = freshness
+        self._jobs: dict[str, ScanJob] = {}
+        self._latest: dict[tuple, ScanJob] = {}  # Most recent job per coalescing key
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scan-worker")
+
+    def submit(self, user_id: str, domain_name: str, options_key: str = "",
+               reuse_fresh: bool = True) -> tuple[ScanJob, bool]:
+        """Queue a scan without waiting for it to run.
+
+        Returns the job and whether it is a new one (False when the request was
+        attached to an in-flight or fresh job).
+        """
+        key = (domain_name, options_key)
+        with self._lock:
+            self._prune()
+            latest = self._latest.get(key)
+            if latest is not None:
+                if latest.status in (QUEUED, RUNNING):
+                    logger.debug(f"Attaching scan of {domain_name} to in-flight job {latest.job_id}")
+                    return latest, False
+                if (reuse_fresh and latest.status == DONE
+                        and datetime.now() - latest.finished_at <= self.freshness):
+                    logger.debug(f"Reusing scan job {latest.job_id} for {domain_name}, finished {latest.finished_at}")
+                    return latest, False
+
+            if self.queued_count() >= self.queue_limit:
+                raise QueueFullError(f"Scan queue is full ({self.queue_limit} jobs waiting)")
+            job = ScanJob(user_id, domain_name, key)
+            self._jobs[job.job_id] = job
+            self._latest[key] = job
+
+        # The job runs on a pool thread; carry the submitter's trace context over
+        self._executor.submit(self._run, job, current_context())
+        logger.debug(f"Queued scan job {job.job_id} for domain {domain_name}")
+        return job, True
+
+    def get(self, job_id: str) -> Optional[ScanJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queued_count(self) -> int:
+        # A snapshot of the values, since the metrics scrape calls this without the lock
+        return sum(1 for job in list(self._jobs.values()) if job.status == QUEUED)
+
+    def running_count(self) -> int:
+        return sum(1 for job in list(self._jobs.values()) if job.status == RUNNING)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _run(self, job: ScanJob, trace_context=None):
+        with attached(trace_context):
+            self._run_job(job)
+
+    def _run_job(self, job: ScanJob):
+        job.status = RUNNING
+        job.started_at = datetime.now()
+        try:
+            job.result = self.scan_func(job.user_id, job.domain_name)
+            status = DONE
+        except ScanFailedError as e:
+            job.error = e.error
+            job.details = e.details
+            status = FAILED
+        except Exception as e:
+            logger.error(f"Scan job {job.job_id} crashed: {e}")
+            job.error = "Failed to process permutations"
+            job.details = str(e)
+            status = FAILED
+        # finished_at is set first so a finished status always has a timestamp
+        job.finished_at = datetime.now()
+        job.status = status
+
+    def _prune(self):
+        """Forget finished jobs older than the TTL. Caller holds the lock."""
+        cutoff = datetime.now() - self.job_ttl
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            job = self._jobs.pop(job_id)
+            if self._latest.get(job.key) is job:
+                del self._latest[job.key]
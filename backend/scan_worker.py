@@ -0,0 +1,292 @@
+"""Distributed scan workers over Pub/Sub.
+
+With SCAN_DISPATCH=pubsub, POST .../permutations publishes a structured
+scan_request message to the frontend-to-backend topic instead of running the
+scan in the API process. Every process subscribed to backend-sub (the backend
+itself and any number of `python scan_worker.py` containers) picks requests
+up under subscriber flow control. A message is acked only after the scan has
+been committed, and nacked for redelivery when it fails in a retriable way.
+Job state lives in the ScanJobRecord table so any replica can report it.
+A unique active_key allows one queued or running job per (domain, options)
+across replicas. Records are pruned once they are older than SCAN_JOB_TTL.
+A job whose publish fails is marked failed and the request gets a 503. A
+message that can't be parsed is acked and logged instead of redelivered.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from uuid import uuid4
+
+from google.cloud import pubsub_v1
+from opentelemetry.trace import SpanKind
+from sqlalchemy import delete, func
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+
+from models import ScanJobRecord
+from tracing import tracer, inject_context
+from scan_jobs import ScanDispatchError, ScanFailedError, SCAN_FRESHNESS, SCAN_JOB_TTL, QUEUED, RUNNING, DONE, FAILED
+
+logger = logging.getLogger(__name__)
+
+SCAN_DISPATCH = os.getenv("SCAN_DISPATCH", "local")  # "local" (in-process pool) or "pubsub"
+SCAN_REQUEST_TYPE = "scan_request"  # Message attribute "type" of scan requests
+SCAN_MAX_ATTEMPTS = int(os.getenv("SCAN_MAX_ATTEMPTS", "3"))  # Deliveries before a job is failed for good
+SUBSCRIBER_MAX_MESSAGES = int(os.getenv("SUBSCRIBER_MAX_MESSAGES", "2"))  # Scans a process runs at once
+SUBSCRIBER_MAX_BYTES = int(os.getenv("SUBSCRIBER_MAX_BYTES", str(10 * 1024 * 1024)))
+SUBSCRIBER_MAX_LEASE_SECONDS = int(os.getenv("SUBSCRIBER_MAX_LEASE_SECONDS", "7200"))  # Longest scan we keep extending
+SCAN_JOB_PRUNE_SECONDS = int(os.getenv("SCAN_JOB_PRUNE_SECONDS", "60"))  # Least time between ScanJobRecord cleanups
+PUBSUB_SETUP_MAX_BACKOFF_SECONDS = float(os.getenv("PUBSUB_SETUP_MAX_BACKOFF_SECONDS", "60"))  # Longest wait between setup attempts
+
+
+def subscriber_flow_control() -> pubsub_v1.types.FlowControl:
+    """Caps outstanding messages and bytes per subscriber so a worker never takes on more scans than it can run."""
+    return pubsub_v1.types.FlowControl(
+        max_messages=SUBSCRIBER_MAX_MESSAGES,
+        max_bytes=SUBSCRIBER_MAX_BYTES,
+        max_lease_duration=SUBSCRIBER_MAX_LEASE_SECONDS,
+    )
+
+
+def active_key(domain_name: str, options_key: str) -> str:
+    """Value of ScanJobRecord.active_key for a queued or running job; its unique index allows one such job per key."""
+    return hashlib.sha1(f"{domain_name}\0{options_key}".encode("utf-8")).hexdigest()
+
+
+def finish_record(record: ScanJobRecord, status: str, error: Optional[str] = None,
+                  details: Optional[str] = None) -> None:
+    """Moves a job to DONE or FAILED and frees its coalescing key for the next scan."""
+    record.status = status
+    record.error = error
+    record.details = details
+    record.finished_at = datetime.now()
+    record.active_key = None
+
+
+def record_to_dict(record: ScanJobRecord) -> dict:
+    """Same shape as ScanJob.to_dict() so the job-status endpoint doesn't care where a job ran."""
+    return {
+        "job_id": record.job_id,
+        "user_id": record.user_id,
+        "domain": record.domain_name,
+        "status": record.status,
+        "created_at": record.created_at.isoformat(),
+        "started_at": record.started_at.isoformat() if record.started_at else None,
+        "finished_at": record.finished_at.isoformat() if record.finished_at else None,
+        "result": json.loads(record.result) if record.result else None,
+        "error": record.error,
+        "details": record.details,
+    }
+
+
+class PubSubScanDispatcher:
+    """Publishes scan jobs to Pub/Sub and tracks them in ScanJobRecord.
+
+    Exposes the same submit()/get() interface as ScanJobManager, including
+    coalescing of in-flight and recently finished scans of a domain.
+    """
+
+    def __init__(self, engine, publisher: pubsub_v1.PublisherClient, topic_path: str,
+                 freshness=SCAN_FRESHNESS, job_ttl=SCAN_JOB_TTL):
+        self.engine = engine
+        self.publisher = publisher
+        self.topic_path = topic_path
+        self.freshness = freshness
+        self.job_ttl = job_ttl
+        self._last_prune: Optional[datetime] = None
+
+    def submit(self, user_id: str, domain_name: str, options_key: str = "",
+               reuse_fresh: bool = True) -> tuple[ScanJobRecord, bool]:
+        now = datetime.now()
+        key = active_key(domain_name, options_key)
+        with Session(self.engine) as session:
+            self._prune(session, now)
+            active = session.exec(select(ScanJobRecord).where(ScanJobRecord.active_key == key)).first()
+            if active is not None:
+                if now - active.created_at <= self.job_ttl:
+                    return active, False
+                # Its message was lost or it never finished; free the key so this request can run
+                finish_record(active, FAILED, "Scan job expired")
+                session.add(active)
+                session.commit()
+            if reuse_fresh:
+                fresh = session.exec(
+                    select(ScanJobRecord)
+                    .where(
+                        (ScanJobRecord.domain_name == domain_name) &
+                        (ScanJobRecord.options_key == options_key) &
+                        (ScanJobRecord.status == DONE) &
+                        (ScanJobRecord.finished_at >= now - self.freshness)
+                    )
+                    .order_by(ScanJobRecord.finished_at.desc())
+                ).first()
+                if fresh is not None:
+                    return fresh, False
+
+            record = ScanJobRecord(job_id=str(uuid4()), user_id=user_id, domain_name=domain_name,
+                                   options_key=options_key, active_key=key)
+            session.add(record)
+            try:
+                session.commit()
+            except IntegrityError:
+                # Another replica queued the same scan between our read and insert
+                session.rollback()
+                active = session.exec(select(ScanJobRecord).where(ScanJobRecord.active_key == key)).first()
+                if active is None:
+                    raise
+                return active, False
+            session.refresh(record)
+
+        payload = json.dumps({
+            "job_id": record.job_id,
+            "user_id": user_id,
+            "domain_name": domain_name,
+            "options_key": options_key,
+        }).encode("utf-8")
+        try:
+            with tracer.start_as_current_span("pubsub.publish", kind=SpanKind.PRODUCER,
+                                              attributes={"messaging.destination": self.topic_path,
+                                                          "job_id": record.job_id}):
+                # The trace context rides along so the worker's scan joins this trace
+                self.publisher.publish(self.topic_path, payload, type=SCAN_REQUEST_TYPE,
+                                       **inject_context()).result()
+        except Exception as e:
+            # Nothing will ever run this job; fail it so later requests don't attach to it
+            logger.error(f"Failed to publish scan job {record.job_id} for domain {domain_name}: {e}")
+            with Session(self.engine) as session:
+                record = session.get(ScanJobRecord, record.job_id)
+                finish_record(record, FAILED, "Failed to queue scan", str(e))
+                session.add(record)
+                session.commit()
+            raise ScanDispatchError(f"Could not queue scan: {e}") from e
+        logger.debug(f"Published scan job {record.job_id} for domain {domain_name}")
+        return record, True
+
+    def get(self, job_id: str) -> Optional[ScanJobRecord]:
+        with Session(self.engine) as session:
+            return session.get(ScanJobRecord, job_id)
+
+    def queued_count(self) -> int:
+        """Jobs published but not yet picked up by any worker."""
+        with Session(self.engine) as session:
+            return session.exec(
+                select(func.count()).select_from(ScanJobRecord).where(ScanJobRecord.status == QUEUED)
+            ).one()
+
+    def _prune(self, session: Session, now: datetime) -> None:
+        """Deletes finished records older than the TTL, and active ones long past any scan's lease.
+
+        Runs at most every SCAN_JOB_PRUNE_SECONDS per process, so submit() doesn't
+        pay for a DELETE every time.
+        """
+        if self._last_prune is not None and (now - self._last_prune).total_seconds() < SCAN_JOB_PRUNE_SECONDS:
+            return
+        self._last_prune = now
+        abandoned = now - self.job_ttl - timedelta(seconds=SUBSCRIBER_MAX_LEASE_SECONDS)
+        result = session.execute(delete(ScanJobRecord).where(
+            (ScanJobRecord.active_key.is_(None) & (ScanJobRecord.finished_at < now - self.job_ttl))
+            | (ScanJobRecord.created_at < abandoned)
+        ))
+        session.commit()
+        if result.rowcount:
+            logger.debug(f"Pruned {result.rowcount} old scan job records")
+
+
+def handle_scan_message(message, engine, scan_func: Callable[[str, str], dict]):
+    """Runs one scan_request message. Acks after the scan commits, nacks retriable failures."""
+    try:
+        request = json.loads(message.data.decode("utf-8"))
+        job_id, user_id, domain_name = request["job_id"], request["user_id"], request["domain_name"]
+    except (ValueError, KeyError, TypeError) as e:
+        # Redelivering it would fail the same way forever
+        logger.error(f"Dropping malformed scan request {message.message_id}: {e}: {message.data[:200]!r}")
+        message.ack()
+        return
+
+    with Session(engine) as session:
+        record = session.get(ScanJobRecord, job_id)
+        if record is None or record.status in (DONE, FAILED):
+            # Unknown job or a redelivery of one that already finished
+            message.ack()
+            return
+        record.status = RUNNING
+        record.attempts += 1
+        record.started_at = datetime.now()
+        session.add(record)
+        session.commit()
+        attempts = record.attempts
+
+    logger.info(f"📩 Running scan job {job_id} for {domain_name} (attempt {attempts})")
+    try:
+        result = scan_func(user_id, domain_name)
+    except Exception as e:
+        error = e.error if isinstance(e, ScanFailedError) else "Failed to process permutations"
+        details = e.details if isinstance(e, ScanFailedError) else str(e)
+        retriable = e.retriable if isinstance(e, ScanFailedError) else True
+        give_up = not retriable or attempts >= SCAN_MAX_ATTEMPTS
+
+        with Session(engine) as session:
+            record = session.get(ScanJobRecord, job_id)
+            if record is not None:  # None when pruned while it ran
+                if give_up:
+                    finish_record(record, FAILED, error, details)
+                else:
+                    record.status = QUEUED
+                    record.error = error
+                    record.details = details
+                session.add(record)
+                session.commit()
+
+        if give_up:
+            logger.error(f"Scan job {job_id} failed: {error}")
+            message.ack()
+        else:
+            logger.warning(f"Scan job {job_id} failed on attempt {attempts}, redelivering: {error}")
+            message.nack()
+        return
+
+    with Session(engine) as session:
+        record = session.get(ScanJobRecord, job_id)
+        if record is not None:
+            record.result = json.dumps(result)
+            finish_record(record, DONE)
+            session.add(record)
+            session.commit()
+    message.ack()
+
+
+def wait_until(check: Callable[[], bool], what: str, max_backoff: float = PUBSUB_SETUP_MAX_BACKOFF_SECONDS) -> None:
+    """Calls `check` until it returns True, doubling the wait between attempts up to `max_backoff` seconds."""
+    delay = 1.0
+    while not check():
+        logger.warning(f"{what} is unavailable, retrying in {delay:.0f}s")
+        time.sleep(delay)
+        delay = min(delay * 2, max_backoff)
+
+
+def main():
+    """Runs a standalone scan worker that only consumes the subscription."""
+    from app import subscriber, subscription_path, callback, ensure_topic, ensure_subscription
+
+    wait_until(ensure_topic, "Pub/Sub topic")
+    wait_until(ensure_subscription, "Pub/Sub subscription")
+    while True:
+        try:
+            streaming_pull_future = subscriber.subscribe(
+                subscription_path, callback=callback, flow_control=subscriber_flow_control()
+            )
+            logger.info(f"🔄 Scan worker listening (max {SUBSCRIBER_MAX_MESSAGES} scans at once)...")
+            streaming_pull_future.result()
+        except Exception as e:
+            logger.error(f"Scan worker subscriber error: {e}")
+            time.sleep(5)
+            # The subscription may be gone, e.g. after the emulator restarted
+            wait_until(ensure_subscription, "Pub/Sub subscription")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import hashlib
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+from uuid import uuid4
+
+from sqlalchemy import func, or_, update
+from sqlmodel import Session, select
+
+from models import Schedule
+from scan_jobs import QueueFullError, QUEUED, RUNNING
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_POLL_SECONDS = int(os.getenv("SCHEDULER_POLL_SECONDS", "30"))  # How often due schedules are claimed
+SCHEDULER_MAX_CONCURRENT = int(os.getenv("SCHEDULER_MAX_CONCURRENT", "4"))  # Scheduled scans running across all replicas
+SCHEDULER_LEASE = timedelta(minutes=int(os.getenv("SCHEDULER_LEASE_MINUTES", "15")))  # Renewed while the scan runs
+SCHEDULE_JITTER_FRACTION = float(os.getenv("SCHEDULE_JITTER_FRACTION", "1.0"))  # Share of the interval schedules are spread over
+
+
+def schedule_interval(schedule: Schedule) -> timedelta:
+    """Hours between scans, derived from the first period for schedules created before interval_hours existed."""
+    if schedule.interval_hours:
+        return timedelta(hours=schedule.interval_hours)
+    if schedule.next_scan and schedule.start_date and schedule.next_scan > schedule.start_date:
+        return schedule.next_scan - schedule.start_date
+    return timedelta(hours=1)
+
+
+def schedule_phase(schedule_id: str, interval: timedelta, fraction: float = SCHEDULE_JITTER_FRACTION) -> timedelta:
+    """Deterministic per-schedule offset into the interval, so schedules created together don't fire together."""
+    spread = int(interval.total_seconds() * fraction)
+    if spread <= 0:
+        return timedelta(0)
+    digest = int.from_bytes(hashlib.sha256(schedule_id.encode()).digest()[:8], "big")
+    return timedelta(seconds=digest % spread)
+
+
+def slot_after(schedule_id: str, start_date: datetime, interval: timedelta, after: datetime) -> datetime:
+    """First scan time strictly after `after` on the grid start_date + phase + k * interval."""
+    anchor = start_date + schedule_phase(schedule_id, interval)
+    if anchor > after:
+        return anchor
+    return anchor + interval * ((after - anchor) // interval + 1)
+
+
+def next_slot(schedule: Schedule, after: datetime) -> datetime:
+    return slot_after(schedule.schedule_id, schedule.start_date, schedule_interval(schedule), after)
+
+
+def plan_scan_load(schedules: list[Schedule], start: datetime, horizon: timedelta,
+                   bucket: timedelta) -> list[dict]:
+    """Projects how many scheduled scans fall into each time bucket between start and start + horizon."""
+    bucket_count = max(1, -(-horizon // bucket))
+    counts = [0] * bucket_count
+    end = start + horizon
+    for schedule in schedules:
+        due = max(schedule.next_scan, start) if schedule.next_scan else next_slot(schedule, start)
+        while due < end:
+            counts[int((due - start) // bucket)] += 1
+            due = next_slot(schedule, due)
+    return [
+        {"start": (start + bucket * i).strftime('%Y-%m-%d %H:%M:%S'), "scans": count}
+        for i, count in enumerate(counts)
+    ]
+
+
+class ScanScheduler:
+    """Claims due Schedule rows and runs them on the scan worker pool.
+
+    Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED and leased to this
+    process, so several backend replicas can run the scheduler without firing a
+    schedule twice. Leases are renewed while the scan runs, and next_scan is
+    advanced (and the lease released) once it finishes.
+    """
+
+    def __init__(self, engine, scan_jobs, options_key: str = "",
+                 max_concurrent: int = SCHEDULER_MAX_CONCURRENT, poll_seconds: int = SCHEDULER_POLL_SECONDS,
+                 lease: timedelta = SCHEDULER_LEASE):
+        self.engine = engine
+        self.scan_jobs = scan_jobs
+        self.options_key = options_key
+        self.max_concurrent = max_concurrent
+        self.poll_seconds = poll_seconds
+        self.lease = lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self._active: dict[str, str] = {}  # schedule_id -> id of the job running it
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="scan-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"⏰ Scheduler {self.owner} started (max {self.max_concurrent} concurrent scans)")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Scheduler error: {e}")
+            self._stop.wait(self.poll_seconds)
+
+    def run_once(self):
+        """One scheduler tick: finish completed scans, keep running ones leased, claim new due ones."""
+        self._finish_completed()
+        self._renew_leases()
+        self._claim_and_dispatch()
+
+    def _claim_and_dispatch(self):
+        now = datetime.now()
+        with Session(self.engine) as session:
+            # Live leases from every replica count towards the global limit
+            active = session.exec(
+                select(func.count()).select_from(Schedule).where(Schedule.lease_expires_at > now)
+            ).one()
+            room = self.max_concurrent - active
+            if room <= 0:
+                return
+
+            due = session.exec(
+                select(Schedule)
+                .where(
+                    (Schedule.next_scan <= now) &
+                    or_(Schedule.lease_expires_at.is_(None), Schedule.lease_expires_at <= now)
+                )
+                .order_by(Schedule.next_scan)
+                .limit(room)
+                .with_for_update(skip_locked=True)
+            ).all()
+
+            claimed = []
+            for schedule in due:
+                schedule.lease_owner = self.owner
+                schedule.lease_expires_at = now + self.lease
+                session.add(schedule)
+                claimed.append((schedule.schedule_id, schedule.user_id, schedule.domain_name))
+            session.commit()
+
+        for schedule_id, user_id, domain_name in claimed:
+            try:
+                job, _ = self.scan_jobs.submit(user_id, domain_name, self.options_key)
+            except QueueFullError as e:
+                logger.warning(f"Scheduler could not queue {domain_name}: {e}")
+                self._release(schedule_id, advance=False)
+                continue
+            logger.info(f"⏰ Dispatched scheduled scan of {domain_name} as job {job.job_id}")
+            self._active[schedule_id] = job.job_id
+
+    def _renew_leases(self):
+        if not self._active:
+            return
+        with Session(self.engine) as session:
+            session.execute(
+                update(Schedule)
+                .where(Schedule.schedule_id.in_(list(self._active)) & (Schedule.lease_owner == self.owner))
+                .values(lease_expires_at=datetime.now() + self.lease)
+            )
+            session.commit()
+
+    def _finish_completed(self):
+        for schedule_id, job_id in list(self._active.items()):
+            # Re-read the job each tick; with Pub/Sub dispatch it runs in another process
+            job = self.scan_jobs.get(job_id)
+            if job is not None and job.status in (QUEUED, RUNNING):
+                continue
+            if job is not None and job.error:
+                logger.warning(f"Scheduled scan of {job.domain_name} failed: {job.error} {job.details or ''}")
+            self._release(schedule_id, advance=True)
+            del self._active[schedule_id]
+
+    def _release(self, schedule_id: str, advance: bool):
+        """Drops this process's lease, moving next_scan to the next slot when the scan ran."""
+        with Session(self.engine) as session:
+            schedule = session.get(Schedule, schedule_id)
+            if schedule is None or schedule.lease_owner != self.owner:
+                return  # Deleted, or the lease expired and another replica took over
+            if advance:
+                if not schedule.interval_hours:
+                    # Pin the derived interval before next_scan moves, or the next run would derive a longer one
+                    schedule.interval_hours = max(1, round(schedule_interval(schedule) / timedelta(hours=1)))
+                schedule.next_scan = next_slot(schedule, datetime.now())
+            schedule.lease_owner = None
+            schedule.lease_expires_at = None
+            session.add(schedule)
+            session.commit()
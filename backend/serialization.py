@@ -0,0 +1,80 @@
+import hashlib
+import os
+from typing import Callable, Iterable, Iterator, Optional
+
+import orjson
+from flask import Response, request
+
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))  # Rows encoded per chunk of a streamed response
+
+
+def json_response(payload) -> Response:
+    """Drop-in for jsonify() on large read responses; orjson encodes rows several times faster."""
+    return Response(orjson.dumps(payload), mimetype="application/json")
+
+
+def cached_json_response(cache, key: str, tags: tuple, build: Callable[[], dict]) -> Response:
+    """Serves the cached body for `key`, or builds the payload, encodes it and caches it under `tags`."""
+    body = cache.get(key)
+    if body is None:
+        body = orjson.dumps(build())
+        cache.set(key, body, tags)
+    return Response(body, mimetype="application/json")
+
+
+def make_etag(*parts) -> str:
+    """Opaque validator for a response that is fully determined by `parts`."""
+    return hashlib.sha1(orjson.dumps([str(part) for part in parts])).hexdigest()
+
+
+def not_modified(etag: str) -> Optional[Response]:
+    """A bodiless 304 when the client's If-None-Match already holds `etag`, otherwise None."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_etag(Response(status=304), etag)
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    """Tags a response and asks clients to revalidate it on every use."""
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def ndjson_chunks(rows: Iterable[dict], batch_size: int = STREAM_BATCH_SIZE) -> Iterator[bytes]:
+    """One JSON document per line, yielded a batch of rows at a time."""
+    batch = []
+    for row in rows:
+        batch.append(orjson.dumps(row))
+        if len(batch) >= batch_size:
+            yield b"\n".join(batch) + b"\n"
+            batch = []
+    if batch:
+        yield b"\n".join(batch) + b"\n"
+
+
+def json_object_chunks(payload: dict, key: str, rows: Iterable[dict], count_key: str,
+                       batch_size: int = STREAM_BATCH_SIZE) -> Iterator[bytes]:
+    """Streams `payload` as a JSON object whose `key` member is the array of rows.
+
+    The fixed fields go out before any row is read, and `count_key` (the number
+    of rows sent) is appended after the array, so nothing has to be buffered.
+    If `rows` raises, the exception propagates and the closing trailer is never
+    written, so a failed stream can't pass for a complete document.
+    """
+    head = orjson.dumps(payload)[:-1]
+    yield head + (b"," if payload else b"") + orjson.dumps(key) + b":["
+
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(orjson.dumps(row))
+        if len(batch) >= batch_size:
+            yield (b"," if count else b"") + b",".join(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        yield (b"," if count else b"") + b",".join(batch)
+        count += len(batch)
+
+    yield b"]," + orjson.dumps(count_key) + b":" + orjson.dumps(count) + b"}"
@@ -0,0 +1,111 @@
+"""Startup work that runs next to the server instead of before it.
+
+Each step (connect to the database, create the schema, ensure the Pub/Sub
+topic, ...) runs on its own thread once the steps it requires are done, and
+is retried every STARTUP_RETRY_SECONDS until it succeeds. Importing the app
+and starting the server therefore never wait on MySQL or Pub/Sub; the
+readiness endpoint reports each step's state instead.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+STARTUP_RETRY_SECONDS = float(os.getenv("STARTUP_RETRY_SECONDS", "5"))  # Wait between attempts of a failed step
+
+PENDING = "pending"
+RUNNING = "running"
+READY = "ready"
+FAILED = "failed"  # Last attempt failed; it is retried
+
+
+class StartupStep:
+    def __init__(self, name: str, func: Callable[[], None], requires: Iterable[str] = (), critical: bool = True):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.critical = critical  # Whether the app is unready until this step is done
+        self.status = PENDING
+        self.attempts = 0
+        self.error: Optional[str] = None
+        self.seconds: Optional[float] = None  # Time from start() until the step succeeded
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "critical": self.critical,
+            "attempts": self.attempts,
+            "error": self.error,
+            "seconds": round(self.seconds, 3) if self.seconds is not None else None,
+        }
+
+
+class Startup:
+    """Runs the registered steps concurrently, each after the steps it requires."""
+
+    def __init__(self, retry_seconds: float = STARTUP_RETRY_SECONDS):
+        self.retry_seconds = retry_seconds
+        self.steps: dict[str, StartupStep] = {}
+        self._stop = threading.Event()
+        self._started_at: Optional[float] = None
+
+    def add(self, name: str, func: Callable[[], None], requires: Iterable[str] = (), critical: bool = True):
+        for required in requires:
+            if required not in self.steps:
+                raise ValueError(f"Startup step {name} requires unknown step {required}")
+        self.steps[name] = StartupStep(name, func, requires, critical)
+
+    def start(self):
+        self._started_at = time.perf_counter()
+        for step in self.steps.values():
+            threading.Thread(target=self._run, args=(step,), name=f"startup-{step.name}", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_ready(self) -> bool:
+        return self._started_at is not None and all(
+            step.status == READY for step in self.steps.values() if step.critical
+        )
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until every critical step is done (or `timeout` passes); True when ready."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for step in self.steps.values():
+            if not step.critical:
+                continue
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not step.done.wait(remaining):
+                return False
+        return True
+
+    def state(self) -> dict:
+        return {"ready": self.is_ready(), "steps": {name: step.to_dict() for name, step in self.steps.items()}}
+
+    def _run(self, step: StartupStep):
+        for required in step.requires:
+            # Wake up now and then so stop() isn't held up by a step that never finishes
+            while not self.steps[required].done.wait(1):
+                if self._stop.is_set():
+                    return
+        while not self._stop.is_set():
+            step.status = RUNNING
+            step.attempts += 1
+            try:
+                step.func()
+            except Exception as e:
+                step.status = FAILED
+                step.error = str(e)
+                logger.error(f"Startup step {step.name} failed (attempt {step.attempts}): {e}")
+                self._stop.wait(self.retry_seconds)
+                continue
+            step.status = READY
+            step.error = None
+            step.seconds = time.perf_counter() - self._started_at
+            step.done.set()
+            logger.info(f"Startup step {step.name} ready after {step.seconds:.2f}s")
+            return
@@ -0,0 +1,64 @@
+import pytest
+from sqlalchemy import insert
+from sqlmodel import SQLModel, Session, create_engine
+
+from ingest import MISSING_RISK, build_permutation_row, fill_missing_risks
+from models import User, Domain, Permutation
+from queries import permutation_filters, permutation_page, permutation_rows
+
+# PYTHONPATH=. python3 -m pytest backend/test_queries.py
+
+DOMAIN = "example.com"
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'queries.sqlite'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add(User(user_id="u1"))
+        session.add(Domain(domain_name=DOMAIN, user_id="u1"))
+        session.commit()
+    return engine
+
+
+def store(engine, risks):
+    """Stores one permutation per risk, including NULL ones as older versions wrote them."""
+    with Session(engine) as session:
+        session.execute(insert(Permutation.__table__), [
+            {"permutation_name": f"p{i:03d}.com", "domain_name": DOMAIN, "risk": risk}
+            for i, risk in enumerate(risks)
+        ])
+        session.commit()
+
+
+def all_pages(engine, limit, descending):
+    names, cursor = [], None
+    with Session(engine) as session:
+        while True:
+            rows, cursor = permutation_page(session, permutation_filters(DOMAIN), limit, cursor, descending)
+            names.extend(row["permutation_name"] for row in rows)
+            if cursor is None:
+                return names
+
+
+@pytest.mark.parametrize("descending", [True, False])
+@pytest.mark.parametrize("limit", [1, 3, 7, 100])
+def test_pages_cover_rows_with_missing_risk(engine, limit, descending):
+    store(engine, [None, 40, 0, None, 40, 95.5, None, 12] * 3)
+    with engine.begin() as conn:
+        assert fill_missing_risks(conn) == 9
+
+    names = all_pages(engine, limit, descending)
+    with Session(engine) as session:
+        listing = permutation_rows(session, permutation_filters(DOMAIN))
+    assert len(names) == len(set(names)) == len(listing) == 24
+    assert set(names) == {row["permutation_name"] for row in listing}
+    assert all(row["risk"] is not None for row in listing)
+
+
+def test_ingest_never_stores_a_missing_risk():
+    row = build_permutation_row({"domain": "exarnple.com", "dns_a": ["1.2.3.4"], "tlsh": 0, "phash": None},
+                                DOMAIN)
+    assert row["risk"] is not None
+    assert row["risk"] > MISSING_RISK
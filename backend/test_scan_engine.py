@@ -0,0 +1,68 @@
+import io
+import json
+
+import pytest
+
+from scan_engine import iter_json_array
+
+# PYTHONPATH=. python3 -m pytest backend/test_scan_engine.py
+
+VALID = [
+    "",
+    "[]",
+    " [ ] ",
+    "[-2.5]",
+    "[1e10]",
+    '["ab", 1.5]',
+    "[0, -0.25e-3, 12345678901234567890, 7E+2]",
+    '[true, false, null, "x\\"y", "\\u00e9"]',
+    '[{"domain": "exаmple.com", "dns_a": ["1.2.3.4"], "tlsh": 87}, [1, [2, []]], {}]',
+    '\n[\n  {"a": 1},\n  {"b": 2}\n]\n',
+]
+
+INVALID = [
+    "[1 2]",
+    "[,1]",
+    "[1,,2]",
+    "[1,]",
+    "[1",
+    '["ab"',
+    "[1.]",
+    "[-]",
+    "[tru]",
+    '{"a": 1}',
+    "1",
+]
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 4, 5, 7, 64])
+@pytest.mark.parametrize("document", VALID)
+def test_parses_like_json_loads(document, read_size):
+    expected = json.loads(document) if document else []
+    assert list(iter_json_array(io.StringIO(document), read_size=read_size)) == expected
+
+
+@pytest.mark.parametrize("read_size", [1, 2, 3, 4, 5, 7, 64])
+@pytest.mark.parametrize("document", INVALID)
+def test_rejects_malformed_arrays(document, read_size):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(document), read_size=read_size))
+
+
+def test_yields_elements_before_the_array_ends():
+    class Stream:
+        """Serves one block and then fails, like a scan that dies halfway through its output."""
+
+        def __init__(self):
+            self.blocks = ['[{"a": 1}, {"b": 2}, ']
+
+        def read(self, size):
+            if not self.blocks:
+                raise RuntimeError("stream broke")
+            return self.blocks.pop(0)
+
+    items = iter_json_array(Stream(), read_size=4)
+    assert next(items) == {"a": 1}
+    assert next(items) == {"b": 2}
+    with pytest.raises(RuntimeError):
+        next(items)
@@ -0,0 +1,141 @@
+"""OpenTelemetry tracing for requests, scans, the database and Pub/Sub.
+
+TRACE_EXPORTER picks where finished spans go: "none" (the default; the API
+stays a no-op), "console" (stdout) or "file" (one JSON span per line in
+TRACE_FILE). Both work offline. Trace context crosses Pub/Sub as W3C
+traceparent/tracestate message attributes, so a scan run by a worker is part
+of the trace of the request that queued it.
+"""
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from opentelemetry import context, propagate, trace
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")  # "none", "console" or "file"
+TRACE_FILE = os.getenv("TRACE_FILE", "logs/traces.jsonl")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "fuzzify-backend")
+
+tracer = trace.get_tracer("fuzzify")
+
+
+def configure_tracing(exporter: str = TRACE_EXPORTER, path: str = TRACE_FILE,
+                      service_name: str = TRACE_SERVICE_NAME) -> None:
+    """Installs the SDK tracer provider with the configured exporter; does nothing for "none"."""
+    if exporter == "none":
+        return
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if exporter == "console":
+        span_exporter = ConsoleSpanExporter()
+    elif exporter == "file":
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        span_exporter = ConsoleSpanExporter(out=open(path, "a"),
+                                            formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        raise ValueError(f"Unknown trace exporter: {exporter}")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(span_exporter))
+    trace.set_tracer_provider(provider)
+    logger.info(f"Tracing enabled, exporting spans to {exporter}")
+
+
+def current_context() -> context.Context:
+    return context.get_current()
+
+
+def start_server_span(name: str, headers, **attributes):
+    """Starts and activates the span of an incoming request, continuing the caller's trace if it sent one.
+
+    Returns the span and the token end_server_span() needs.
+    """
+    span = tracer.start_span(name, context=extract_context(headers), kind=trace.SpanKind.SERVER,
+                             attributes=attributes)
+    return span, context.attach(trace.set_span_in_context(span))
+
+
+def end_server_span(span, token, error: Optional[BaseException] = None) -> None:
+    if error is not None:
+        span.record_exception(error)
+        span.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+    span.end()
+    context.detach(token)
+
+
+def inject_context() -> dict:
+    """The current trace context as Pub/Sub message attributes."""
+    carrier: dict = {}
+    propagate.inject(carrier)
+    return carrier
+
+
+def extract_context(carrier) -> context.Context:
+    """Trace context from incoming HTTP headers or Pub/Sub message attributes."""
+    return propagate.extract(carrier)
+
+
+@contextmanager
+def attached(ctx: Optional[context.Context]):
+    """Makes `ctx` current for the block, e.g. on the thread that runs a queued job."""
+    if ctx is None:
+        yield
+        return
+    token = context.attach(ctx)
+    try:
+        yield
+    finally:
+        context.detach(token)
+
+
+def traced_iter(iterable: Iterable, name: str, **attributes) -> Iterator:
+    """Yields from `iterable` under a span that ends when it is exhausted.
+
+    The span is only current while the iterable runs, not while the consumer
+    handles an item, so spans the producer opens nest under it. It records
+    the number of items and the time spent producing them.
+    """
+    span = tracer.start_span(name, attributes=attributes)
+    span_context = trace.set_span_in_context(span)
+    iterator = iter(iterable)
+    items = 0
+    busy = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            token = context.attach(span_context)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            except Exception as e:
+                span.record_exception(e)
+                span.set_status(trace.Status(trace.StatusCode.ERROR, str(e)))
+                raise
+            finally:
+                context.detach(token)
+                busy += time.perf_counter() - started
+            items += 1
+            yield item
+    finally:
+        span.set_attribute("items", items)
+        span.set_attribute("busy_seconds", round(busy, 6))
+        span.end()
+
+
+def record_aggregate_span(name: str, seconds: float, **attributes) -> None:
+    """Records work spread across a stream (e.g. JSON decoding between reads) as one span ending now.
+
+    Its duration is the summed time of that work, not a contiguous interval.
+    """
+    end = time.time_ns()
+    span = tracer.start_span(name, start_time=end - int(seconds * 1e9),
+                             attributes=dict(attributes, aggregated=True))
+    span.end(end_time=end)
@@ -48,6 +48,34 @@ const countPermutations = async ({ userId }: { userId: string }): Promise<number
   }
 };
 
+export interface ScanJob {
+  job_id: string;
+  status: 'queued' | 'running' | 'done' | 'failed';
+  domain: string;
+  result: { message: string } | null;  // Scan summary once the job is done
+  error: string | null;
+  details: string | null;
+}
+
+const SCAN_POLL_INTERVAL_MS = 2000;
+const SCAN_POLL_TIMEOUT_MS = 60 * 60 * 1000;  // Give up waiting after an hour, when the backend drops finished jobs
+const SCAN_POLL_MAX_ERRORS = 5;  // Consecutive failed status checks before giving up
+
+// Returns null when the backend no longer knows the job (expired, or lost with its worker)
+const fetchScanJob = async ({ userId, jobId }: { userId: string, jobId: string }): Promise<ScanJob | null> => {
+  const response = await fetch(`${API_BASE_URL}/api/${userId}/scan-jobs/${jobId}`);
+
+  if (response.status === 404) {
+    return null;
+  }
+  if (!response.ok) {
+    const errorData = await response.json().catch(() => ({}));
+    throw new Error(errorData.error || "Failed to fetch scan status");
+  }
+
+  return response.json();
+};
+
 const generatePermutations = async ({ userId, domainName }: { userId: string, domainName: string }): Promise<{ message: string }> => {
   const response = await fetch(`${API_BASE_URL}/api/${userId}/${domainName}/permutations`, {
     method: "POST",
@@ -58,13 +86,38 @@ const generatePermutations = async ({ userId, domainName }: { userId: string, do
   
   if (!response.ok) {
     const errorData = await response.json().catch(() => ({}));
-    throw new Error(errorData.message || "Failed to generate permutations");
+    throw new Error(errorData.error || errorData.message || "Failed to generate permutations");
   }
   
-  return response.json();
+  // The scan runs in the background; poll its job until it finishes
+  const { job_id: jobId } = await response.json();
+  const deadline = Date.now() + SCAN_POLL_TIMEOUT_MS;
+  let errors = 0;
+  while (Date.now() < deadline) {
+    await new Promise((resolve) => setTimeout(resolve, SCAN_POLL_INTERVAL_MS));
+    let job: ScanJob | null;
+    try {
+      job = await fetchScanJob({ userId, jobId });
+      errors = 0;
+    } catch (error) {
+      if (++errors >= SCAN_POLL_MAX_ERRORS) {
+        throw error;
+      }
+      continue;
+    }
+    if (job === null) {
+      throw new Error("The scan job was not found; it may have expired. Please try again.");
+    }
+    if (job.status === "done") {
+      return job.result ?? { message: "Permutations processed successfully" };
+    }
+    if (job.status === "failed") {
+      throw new Error(job.details ? `${job.error}: ${job.details}` : job.error || "Failed to generate permutations");
+    }
+  }
+  throw new Error("Timed out waiting for the scan to finish. Please try again later.");
 };
 
-
 export function useCountPermutations(userId: string) {
   return useQuery({
     queryKey: ["permutations-count", userId],